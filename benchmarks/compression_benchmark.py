@@ -0,0 +1,83 @@
+# *****************************************************************************
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Davis V. Garrad <davis.last@psi.ch>
+#
+# *****************************************************************************
+
+# Write throughput vs. file size of the storage settings of the NeXus sink (see sinks/storage_policy.py), on synthetic FIDs.
+# Runs without NICOS:
+#   python benchmarks/compression_benchmark.py [number of FIDs] [points per FID]
+
+import os
+import sys
+import tempfile
+import time
+
+import h5py as hdf
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sinks.storage_policy import apply_dtype, dataset_options
+
+SETTINGS = {
+    'none (float64)':          {},
+    'float32':                 {'dtype': 'float32'},
+    'lzf':                     {'compression': 'lzf'},
+    'lzf+shuffle':             {'compression': 'lzf', 'shuffle': True},
+    'gzip1+shuffle':           {'compression': 'gzip', 'level': 1, 'shuffle': True},
+    'gzip4+shuffle':           {'compression': 'gzip', 'level': 4, 'shuffle': True},
+    'gzip4+shuffle, float32':  {'compression': 'gzip', 'level': 4, 'shuffle': True, 'dtype': 'float32'},
+    'lzf+shuffle, float32':    {'compression': 'lzf', 'shuffle': True, 'dtype': 'float32'},
+}
+
+def make_fids(n, length, seed=0):
+    '''Decaying, off-resonance echoes with noise, quantised like averaged ADC counts. Returns (reals, imags), each (n, length).'''
+    rng = np.random.default_rng(seed)
+    t = np.arange(length) * 0.2 # us
+    t2 = rng.uniform(5, 50, size=(n, 1))
+    df = rng.uniform(-0.2, 0.2, size=(n, 1)) # MHz
+    amp = rng.uniform(1e3, 1e4, size=(n, 1))
+    fid = amp * np.exp(-t/t2) * np.exp(2j*np.pi*df*t) + rng.normal(scale=50, size=(n, length)) + 1j*rng.normal(scale=50, size=(n, length))
+    fid = np.round(fid.real) + 1j*np.round(fid.imag) # TNMR hands out summed integer counts, as floats
+    return fid.real.copy(), fid.imag.copy()
+
+def run(settings, reals, imags, path):
+    t0 = time.perf_counter()
+    with hdf.File(path, 'w') as f:
+        for i in range(reals.shape[0]):
+            g = f.create_group(f'entry{i+1}/nmr_data')
+            for name, arr in (('tnmr_reals', reals[i]), ('tnmr_imags', imags[i])):
+                arr = apply_dtype(settings, arr)
+                g.create_dataset(name, data=arr, **dataset_options(settings, arr.shape))
+    dt = time.perf_counter() - t0
+    return dt, os.path.getsize(path)
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    reals, imags = make_fids(n, length)
+    raw_mb = (reals.nbytes + imags.nbytes) / 1e6
+    print(f'{n} FIDs of {length} points ({raw_mb:.1f} MB as float64)')
+    print(f'{"settings":<26}{"time (s)":>10}{"MB/s":>10}{"size (MB)":>12}{"ratio":>8}')
+    with tempfile.TemporaryDirectory() as d:
+        for name, settings in SETTINGS.items():
+            dt, size = run(settings, reals, imags, os.path.join(d, 'bench.hdf'))
+            print(f'{name:<26}{dt:>10.2f}{raw_mb/dt:>10.1f}{size/1e6:>12.2f}{raw_mb*1e6/size:>8.2f}')
+
+if __name__ == '__main__':
+    main()
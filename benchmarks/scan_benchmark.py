@@ -0,0 +1,96 @@
+# *****************************************************************************
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Davis V. Garrad <davis.last@psi.ch>
+#
+# *****************************************************************************
+
+# End-to-end scan benchmark: T1, T2 and field-sweep workloads through scan_sequences/sweep_setpoints and the real NeXus sink, on the simulated
+# TNMR module (setups/tnmr_sim.py). Reports points per second, the host overhead per point (wall time not spent acquiring), and the bytes written.
+# In a NICOS session with the tnmr_sim setup loaded:
+#   run('<path to>/benchmarks/scan_benchmark.py')
+# The settings below can be changed before running it.
+
+import os
+import time
+
+from nicos import session
+
+import nicos_sinq.tnmr.commands.tnmr_commands as tnmr_commands
+from nicos_sinq.tnmr.commands.tnmr_commands import tnmr_scan, generate_pulse, generate_sequences, log_durations, scan_sequences, sweep_setpoints
+
+DEVICE = 'nmr_daq_scout'
+MAGNET = 'se_mf'
+POINTS = 20 # per workload
+TIME_SCALE = 0.05 # of the simulated acquisitions, so that the host overhead dominates
+NUM_POINTS = 4096 # per FID
+PIPELINED = (False, True)
+
+def t1_workload(dev, pipelined):
+    seq = [ generate_pulse(5, 40, 1, '0 2'), generate_pulse(2.5, 40, 50, '0 2'), generate_pulse(5, 40, 0, '0 2') ]
+    scan_sequences(dev, generate_sequences(seq, [0], 'delay_time', log_durations(10, 100_000, POINTS)), pipelined=pipelined)
+    return POINTS
+
+def t2_workload(dev, pipelined):
+    seq = [ generate_pulse(2.5, 40, 50, '0 2'), generate_pulse(5, 40, 0.1, '0 2') ]
+    scan_sequences(dev, generate_sequences(seq, [0], 'delay_time', log_durations(10, 10_000, POINTS)), pipelined=pipelined)
+    return POINTS
+
+def magsweep_workload(dev, pipelined):
+    seq = [ generate_pulse(2.5, 40, 50, '0 2'), generate_pulse(5, 40, 0.1, '0 2') ]
+    magnet = session.getDevice(MAGNET)
+    start = magnet.read(0)
+    sweep_setpoints(dev, seq, magnet, [ start + i*1e-3 for i in range(POINTS) ], tolerance=1e-4)
+    return POINTS
+
+WORKLOADS = { 'T1': t1_workload, 'T2': t2_workload, 'magsweep': magsweep_workload }
+
+def run_workload(name, func, pipelined):
+    tnmr = session.getDevice(DEVICE)
+    acquired = tnmr.acquired_time
+    t0 = time.monotonic()
+    with tnmr_scan(): # one file per workload, so its size can be measured
+        files = list(getattr(tnmr_commands.TNMR_CURRENT_DATASET, 'tnmr_files', []))
+        n = func(DEVICE, pipelined)
+    wall = time.monotonic() - t0
+    acquiring = tnmr.acquired_time - acquired
+    size = sum(os.path.getsize(f) for f in files if os.path.exists(f))
+    return { 'workload': name, 'pipelined': pipelined, 'points': n, 'wall': wall, 'points_per_s': n/wall,
+             'overhead_per_point': (wall - acquiring)/n, 'bytes': size, 'bytes_per_point': size/n }
+
+def main():
+    tnmr = session.getDevice(DEVICE)
+    saved = (tnmr.time_scale, tnmr.num_points)
+    tnmr.time_scale = TIME_SCALE
+    tnmr.num_points = NUM_POINTS
+    results = []
+    try:
+        for name, func in WORKLOADS.items():
+            for pipelined in PIPELINED:
+                if(name == 'magsweep') and (pipelined):
+                    continue # sweep_setpoints overlaps the ramp instead
+                results += [ run_workload(name, func, pipelined) ]
+    finally:
+        tnmr.time_scale, tnmr.num_points = saved
+    
+    session.log.info(f'{POINTS} points per workload, FIDs of {NUM_POINTS} points, acquisitions at {TIME_SCALE}x real time')
+    session.log.info(f'{"workload":<12}{"pipelined":>10}{"points/s":>10}{"overhead/point (ms)":>21}{"MB written":>12}{"kB/point":>10}')
+    for r in results:
+        session.log.info(f'{r["workload"]:<12}{str(r["pipelined"]):>10}{r["points_per_s"]:>10.2f}{r["overhead_per_point"]*1e3:>21.1f}{r["bytes"]/1e6:>12.2f}{r["bytes_per_point"]/1e3:>10.1f}')
+    return results
+
+main()
@@ -24,39 +24,72 @@ import math
 from datetime import datetime
 import traceback
 
+import numpy as np
+
 from nicos import session
+from nicos.core import SIMULATION
 from nicos.core.data import DataManager
 from nicos.core.data.dataset import PointDataset, ScanDataset
 import nicos.core.constants as consts
 from nicos.commands import helparglist, usercommand, parallel_safe
-from nicos.commands.basic import sleep as nicossleep
 from nicos.commands.device import maw
 from nicos.utils import createThread
 
+from nicos_sinq.tnmr.commands.tnmr_sequences import sweep_grid, as_index_list
+from nicos_sinq.tnmr.commands.tnmr_eta import ScanETA, timing_snapshot, sequence_durations, get_timing_model, timing_models
+from nicos_sinq.tnmr.commands.tnmr_waiter import AcquisitionWaiter
+from nicos_sinq.tnmr.commands.tnmr_upload import UPLOAD_CACHE, content_hash
+from nicos_sinq.tnmr.commands.tnmr_journal import ScanJournal, point_keys, new_journal_path
+from nicos_sinq.tnmr.commands.tnmr_sweep import SetpointMover
+from nicos_sinq.tnmr.commands.tnmr_processing import PROCESSING, WINDOWS, fid_stage
+from nicos_sinq.tnmr.commands.tnmr_relaxation import RelaxationFit
+from nicos_sinq.tnmr.commands.tnmr_timing import PHASE_TIMING
+from nicos_sinq.tnmr.sinks import HDF5_NEXUS
+
 TNMR_CURRENTLY_SCANNING = None
+TNMR_CURRENT_DATASET = None
 
 class tnmr_scan:
-    '''Always acts as a context manager for the data manager. Only the top level tnmr_scan object actually controls the opening and closing of files. '''
-    def __init__(self):
+    '''Always acts as a context manager for the data manager. Only the top level tnmr_scan object actually controls the opening and closing of files.
+    If resume_files (paths of existing scan files) are given, the top level tnmr_scan writes into those instead of opening new files.'''
+    def __init__(self, resume_files=None):
         self.toplevel = False
+        self.resume_files = resume_files
 
     def __enter__(self):
-        global TNMR_CURRENTLY_SCANNING
+        global TNMR_CURRENTLY_SCANNING, TNMR_CURRENT_DATASET
         
         if(TNMR_CURRENTLY_SCANNING is None):
             dm = DataManager()
-            db = dm.beginScan()
+            HDF5_NEXUS.RESUME_FILES[:] = self.resume_files or [] # read by the sink handlers, which beginScan prepares
+            try:
+                db = dm.beginScan()
+            finally:
+                HDF5_NEXUS.RESUME_FILES[:] = []
             TNMR_CURRENTLY_SCANNING = dm
+            TNMR_CURRENT_DATASET = db
             self.toplevel = True
+            self.starttime = time.monotonic()
+            for model in timing_models():
+                model.begin_scan()
             
         return TNMR_CURRENTLY_SCANNING
             
     def __exit__(self, exc_type, exc_value, traceback):
-        global TNMR_CURRENTLY_SCANNING
+        global TNMR_CURRENTLY_SCANNING, TNMR_CURRENT_DATASET
         if not(TNMR_CURRENTLY_SCANNING is None) and (self.toplevel):
             TNMR_CURRENTLY_SCANNING.finishScan()
             TNMR_CURRENTLY_SCANNING = None
+            TNMR_CURRENT_DATASET = None
+            PHASE_TIMING.publish() # percentiles of the point phases, if phase timing is on
             session.log.info('Closing scan file context')
+            for model in timing_models():
+                model.end_scan(time.monotonic() - self.starttime)
+            if(session.mode != SIMULATION):
+                try:
+                    get_timing_model().save()
+                except Exception:
+                    session.log.warning('Could not save the TNMR timing model', exc=1)
         return False
     
 @usercommand
@@ -79,29 +112,41 @@ def generate_pulse(pw, ph, dt, pc):
 
 @usercommand
 @parallel_safe
-@helparglist('a pulse sequence to be copied and altered, pulse(s) to be scanned (zero-indexed) (in the case of multiple, all will scan concurrently), variable name (i.e., "pulse_width", "pulse_height", "delay_time", or "phase_cycle"), list of values')
-def generate_sequences(base_sequence, pulse_indices, var_name, vals):
-    try:
-        pulse_indices = list(pulse_indices) # convert to list if tuple, single element, etc.. This is so we can just treat it homogeneously throughout the function
-    except:
-        try:
-            pulse_indices = [ pulse_indices ]
-        except:
-            raise TypeError
-
+@helparglist('a pulse sequence to be copied and altered, pulse(s) to be scanned (zero-indexed) (in the case of multiple, all will scan concurrently), variable name (i.e., "pulse_width", "pulse_height", "delay_time", or "phase_cycle"), list of values, [compact]')
+def generate_sequences(base_sequence, pulse_indices, var_name, vals, compact=False):
+    """
+    Generates one copy of base_sequence per value in vals, with var_name of the given pulse(s) set to that value.
+    By default a list of pulse sequences (lists of dictionaries) is returned. With compact=True, a SequenceArray is returned instead, which
+    can be passed to scan_sequences all the same, but does not create the dictionaries until a sequence is actually used (its pulses can only
+    have the usual four keys, and their widths, heights and delays are stored as floats).
+    """
+    if(compact):
+        return sweep_grid(base_sequence, [ (pulse_indices, var_name, vals) ], mode='zip')
+    # plain copies of the dictionaries, which keeps any other keys and the types of the values as they are
+    pulse_indices = as_index_list(pulse_indices)
     ret = []
-    
     for v in vals:
-        temp_seq = []
-        for i in range(len(base_sequence)): # per-pulse
-            temp_seq += [base_sequence[i].copy()]
-    
-            if(i in pulse_indices):
-                temp_seq[i][var_name] = v
-        ret += [temp_seq]
-
+        temp_seq = [ p.copy() for p in base_sequence ]
+        for i in pulse_indices:
+            temp_seq[i][var_name] = v
+        ret += [ temp_seq ]
     return ret
 
+@usercommand
+@parallel_safe
+@helparglist('a pulse sequence to be copied and altered, a list of (pulse(s), variable name, list of values) sweeps, "product" or "zip"')
+def generate_sequence_grid(base_sequence, sweeps, mode='product'):
+    """
+    Generates pulse sequences sweeping several variables at once, as a SequenceArray (which scan_sequences accepts like a list of sequences).
+    With mode="product", every combination of the sweep values is generated (the last sweep varies fastest); with mode="zip", the sweeps are stepped through together.
+    Example (delay times x pulse widths):
+
+    seqs = generate_sequence_grid(seq, [ ([0], 'delay_time', log_durations(10, 1e6, 20)), ([1], 'pulse_width', [2, 2.5, 3]) ])
+    seqs.coords # the swept values of every sequence
+    scan_sequences(nmr_daq_scout, seqs)
+    """
+    return sweep_grid(base_sequence, sweeps, mode)
+
 @usercommand
 @parallel_safe
 @helparglist('start time (us), end time (us), number of points (end inclusive)')
@@ -113,48 +158,26 @@ def log_durations(s, e, N):
 @parallel_safe
 @helparglist('the TNMR instance/virtual device to pull parameters from, a pulse sequence to estimate')
 def estimate_sequence_length_from_device(dev, seq):
-    eta = 0.0 # seconds
-    tnmr = session.getDevice(dev)
-    eta += tnmr.acquisition_time * 1e-6
-    eta += tnmr.pre_acquisition_time * 1e-6
-    eta += tnmr.post_acquisition_time * 1e-3
-    for i in seq:
-        eta += i['delay_time'] * 1e-6
-        eta += i['pulse_width'] * 1e-6
-    eta *= tnmr.num_acqs
-    return eta
+    return estimate_sequence_length(timing_snapshot(dev), seq)
    
 @usercommand
 @parallel_safe
 @helparglist('a dictionary of parameters (acquisition_time, pre_acquisition_time, post_acquisition_time, and num_acqs), a pulse sequence to estimate') 
 def estimate_sequence_length(params, seq):
-    eta = 0.0 # seconds
-    eta += params['acquisition_time'] * 1e-6
-    eta += params['pre_acquisition_time'] * 1e-6
-    eta += params['post_acquisition_time'] * 1e-3
-    for i in seq:
-        eta += i['delay_time'] * 1e-6
-        eta += i['pulse_width'] * 1e-6
-    eta *= params['num_acqs']
-    return eta
+    return float(sequence_durations(params, [ seq ])[0]) # seconds
 
 @usercommand
 @parallel_safe
 @helparglist('the TNMR instance/virtual device to be used, a sequence of pulse sequences to estimate')
 def estimate_scan_length_from_device(dev, scan_seq):
-    total_eta = 0.0
-    for j in scan_seq:
-        total_eta += estimate_sequence_length_from_device(dev, j)
-    return total_eta
+    # one snapshot of the device parameters for the whole scan, instead of one per sequence
+    return estimate_scan_length(timing_snapshot(dev), scan_seq)
 
 @usercommand
 @parallel_safe
 @helparglist('a dictionary of parameters (acquisition_time, pre_acquisition_time, post_acquisition_time, and num_acqs), a sequence of pulse sequences to estimate')
 def estimate_scan_length(params, scan_seq):
-    total_eta = 0.0
-    for j in scan_seq:
-        total_eta += estimate_sequence_length(params, j)
-    return total_eta      
+    return float(sequence_durations(params, scan_seq).sum())
 
 @usercommand
 @parallel_safe
@@ -178,6 +201,8 @@ def timestring(seconds):
         etastr = f'{seconds*1e6:.1f}us'
     elif(seconds > 1e-9):
         etastr = f'{seconds*1e9:.1f}ns'
+    else:
+        etastr = f'{seconds:.1f}s'
     
     endtime = time.time() + seconds
     enddatetime = datetime.fromtimestamp(endtime)
@@ -202,102 +227,446 @@ def print_sequence(seq):
 def get_tnmr_params(dev):
     tnmr = session.getDevice(dev)
     params_dictionary = {
-                          'acquisition_time':      dev.acquisition_time,
-                          'ringdown_time':         dev.ringdown_time,
-                          'pre_acquisition_time':  dev.pre_acquisition_time,
-                          'post_acquisition_time': dev.post_acquisition_time,
-                          'acq_phase_cycle':       dev.acq_phase_cycle,
-                          'obs_freq':              dev.obs_freq,
-                          'num_acqs':              dev.num_acqs,
-                          'actual_num_acqs':       dev.num_acqs_actual,
+                          'acquisition_time':      tnmr.acquisition_time,
+                          'ringdown_time':         tnmr.ringdown_time,
+                          'pre_acquisition_time':  tnmr.pre_acquisition_time,
+                          'post_acquisition_time': tnmr.post_acquisition_time,
+                          'acq_phase_cycle':       tnmr.acq_phase_cycle,
+                          'obs_freq':              tnmr.obs_freq,
+                          'num_acqs':              tnmr.num_acqs,
+                          'actual_num_acqs':       tnmr.num_acqs_actual,
                         }
     return params_dictionary
 
+class ChangeTracker:
+    '''Remembers what was last sent to the sink for each key during a point, so that unchanged values are not serialised and written again.
+    A value can come with a version (anything comparable, e.g. the number of acquisitions so far), which is then compared instead of the value itself;
+    otherwise a content hash of the value is compared.'''
+    def __init__(self):
+        self.last = {}
+        self.skipped = 0
+
+    def changed(self, key, value, version=None):
+        tag = ('version', version) if not(version is None) else ('hash', content_hash(value))
+        if(self.last.get(key, None) == tag):
+            self.skipped += 1
+            return False
+        self.last[key] = tag
+        return True
+
 @usercommand
 @helparglist('the reference name of the tnmr module, a pulse sequence to scan')
-def scan_sequence(dev, seq, additional_saving_lambdas={}):
+def scan_sequence(dev, seq, additional_saving_lambdas={}, on_acquired=None, uploaded=False):
+    """
+    Runs one pulse sequence and writes it as one point (entry) into the scan file.
+    on_acquired (optional) is called without arguments as soon as the acquisition has finished and its final values have been handed to the sink,
+    but before the point is finished; it lets callers overlap their own work (e.g., uploading the next sequence) with the write-out. If it fails, a
+    warning is logged and the point is finished all the same. If uploaded is True, the sequence is assumed to be on the spectrometer already.
+    Returns the start time of the point (UNIX time), or None if it was not measured.
+    """
+    point_start = time.monotonic()
+    timer = PHASE_TIMING.timer() # does nothing unless phase timing is on (set_phase_timing)
     try:
+        model = get_timing_model(dev) # the one of the simulated device, if dev is one
+        # inside the try, so that a parameter which cannot be read only costs this point, not the whole scan
+        timing_params = timing_snapshot(dev)
+        predicted_length = estimate_sequence_length(timing_params, seq)
+        estimated_length = float(model.calibrate(timing_params, predicted_length)) # corrected by what previous points really took
+        if(session.mode == SIMULATION):
+            session.clock.tick(estimated_length) # so that dry runs (and the ETA of the script status panel) account for this point
+            return None
         tnmr = session.getDevice(dev)
         with tnmr_scan() as dm: # open a file if one is not already opened; if one is, this just gives us a reference to the appropriate datamanager.
             pb = dm.beginPoint()
             
-            tnmr.sequence_data = seq
+            if not(uploaded):
+                with timer.phase('upload'):
+                    UPLOAD_CACHE.upload_sequence(tnmr, seq) # skipped if the spectrometer has this sequence already
             print_sequence(seq)
-            estimated_length = estimate_sequence_length_from_device(dev, seq)
             session.log.info(f'Point ETA: {timestring(estimated_length)}')
-            tnmr.compile_and_run(False)
+            with timer.phase('compile_and_run'):
+                tnmr.compile_and_run(False)
             
             finished = False
             starttime = time.time() # To signal when measurement started (approximately. This will not be nanosecond-precise, but it's good enough for our purposes)
             
-            while not(finished):
-                data = tnmr.read() # get latest data, with records about the # of acquisitions that have been performed.
-                
-                finished = (tnmr.status()[0] <= 200) # at the start so final values will be written
-                nicossleep(tnmr.pollinterval) # A metric as good as any
-                if(finished):
-                    st = time.time() # Start a timeout clock, essentially
-                    while (time.time() - st < 30) and (tnmr.num_acqs_actual != tnmr.num_acqs):
-                        nicossleep(0.5) # get up to date values
-                        tnmr.read()
+            # Now we need to put our sequence (list of dictionaries) into the form that our file handler wants (dictionary of dictionaries). The keys on the sequences should be informative of the order, so we just set them as the indices of the original list because that will never be unclear.
+            sequence_dictionary = {}
+            for i in range(len(seq)):
+                sequence_dictionary[i] = seq[i]
+            with timer.phase('params'):
+                params_dict = get_tnmr_params(dev) # only the acquisition count changes during the point; everything is read again at the end
+            tracker = ChangeTracker() # so that values which did not change since the last poll are not sent to the sink again
+            processing = None
+            
+            with AcquisitionWaiter(tnmr, estimated_length) as waiter:
+                while not(finished):
+                    with timer.phase('read'):
+                        data = tnmr.read() # get latest data, with records about the # of acquisitions that have been performed.
+                        num_acqs_actual = tnmr.num_acqs_actual # read together with the data, as its version
                 
-                # Now we need to put our sequence (list of dictionaries) into the form that our file handler wants (dictionary of dictionaries). The keys on the sequences should be informative of the order, so we just set them as the indices of the original list because that will never be unclear.
-                sequence_dictionary = {}
-                for i in range(len(seq)):
-                    sequence_dictionary[i] = seq[i]
+                    with timer.phase('status'):
+                        finished = (tnmr.status()[0] <= 200) # at the start so final values will be written
+                    if(finished):
+                        with timer.phase('read'):
+                            data = waiter.wait_for_counts(30) # the status can be ahead of the acquisition count
+                            num_acqs_actual = tnmr.num_acqs_actual
+                        with timer.phase('params'):
+                            params_dict = get_tnmr_params(dev)
+                    else:
+                        with timer.phase('acquisition'):
+                            waiter.wait() # until the next poll is due, or the device reports something new
+                        params_dict = dict(params_dict, actual_num_acqs=num_acqs_actual) # a new dictionary, the last one may still be queued in the sink
                 
-                # Construct a whole dictionary for all the different values we want to pass to the file writer. The key is going to be the key of the data in the end; in the NeXus handler, I've programmed in some "magic" identifiers, such as signal:, axes:, auxiliary_signal:, metadata/, and environment/. These each designate a different place for the data to reside ('/') or be given a NeXus attribute (':').and/or jhavereside and 
-                params_dict = get_tnmr_params(dev)
-                full_value_dict = {
-                    'signal:tnmr_reals':               (starttime, data['reals']), 
-                    'auxiliary_signals:tnmr_imags':    (starttime, data['imags']),  
-                    'axes:tnmr_times':                 (starttime, data['t']),
-                    'tnmr_sequence':                   (starttime, sequence_dictionary),
-                    'tnmr_params':                     (starttime, params_dict),
-                    'metadata/nucleus':                (starttime, tnmr.nucleus),
-                    'metadata/sample':                 (starttime, tnmr.sample),
-                    'metadata/comments':               (starttime, tnmr.comments),
-                }
-                for fkey, func in additional_saving_lambdas.items():
-                    try:
-                        full_value_dict['environment/'+fkey] = (starttime, func())
-                    except:
-                        session.log.warning(f'Could not acquire parameter `{fkey}` for writing into NeXus file. Traceback: \n{traceback.format_exc()}')
-                        pass
+                    # Construct a whole dictionary for all the different values we want to pass to the file writer. The key is going to be the key of the data in the end; in the NeXus handler, I've programmed in some "magic" identifiers, such as signal:, axes:, auxiliary_signal:, metadata/, and environment/. These each designate a different place for the data to reside ('/') or be given a NeXus attribute (':').and/or jhavereside and 
+                    # The FID only changes with the number of acquisitions, so that is its version. The sequence and metadata are sent once per point.
+                    data_version = (num_acqs_actual, len(data['reals']), finished)
+                    full_value_dict = {}
+                    for key, val, version in (('signal:tnmr_reals',            data['reals'],       data_version),
+                                              ('auxiliary_signals:tnmr_imags', data['imags'],       data_version),
+                                              ('axes:tnmr_times',              data['t'],           data_version),
+                                              ('tnmr_sequence',                sequence_dictionary, 0),
+                                              ('tnmr_params',                  params_dict,         None),
+                                              ('metadata/nucleus',             tnmr.nucleus,        0),
+                                              ('metadata/sample',              tnmr.sample,         0),
+                                              ('metadata/comments',            tnmr.comments,       0)):
+                        if(tracker.changed(key, val, version)):
+                            full_value_dict[key] = (starttime, val)
+                    for fkey, func in additional_saving_lambdas.items():
+                        try:
+                            with timer.phase('environment'):
+                                val = func()
+                            if(tracker.changed('environment/'+fkey, val)):
+                                full_value_dict['environment/'+fkey] = (starttime, val)
+                        except:
+                            session.log.warning(f'Could not acquire parameter `{fkey}` for writing into NeXus file. Traceback: \n{traceback.format_exc()}')
+                            pass
+                    if(finished):
+                        # how long the point idled between the end of the acquisition and its final write
+                        full_value_dict['metadata/idle_after_acquisition'] = (starttime, waiter.idle_time())
+                        session.log.debug(f'Point idled {timestring(waiter.idle_time())} after the acquisition finished ({waiter.num_events} device updates received, {tracker.skipped} unchanged values not sent)')
+                        # derived values (spectra etc.) are computed in the background, while the point is written out
+                        processing = PROCESSING.submit({ 'reals': data['reals'], 'imags': data['imags'], 't': data['t'], 'params': dict(params_dict), 'sequence': seq })
             
-                dm.putValues(full_value_dict)                        
-            dm.finishPoint()
+                    if(full_value_dict):
+                        with timer.phase('put_values'):
+                            dm.putValues(full_value_dict)
+                    if(finished) and not(on_acquired is None):
+                        # only now, so that the final values (and the sink's snapshot of the environment) are from before e.g. a ramp is started
+                        with timer.phase('on_acquired'):
+                            try:
+                                on_acquired()
+                            except Exception:
+                                session.log.warning(f'on_acquired failed, finishing the point anyway. Traceback: \n{traceback.format_exc()}')
+            # tagged derived: the sink writes them without reading the devices again, which may be moving to the next setpoint by now (on_acquired)
+            final_values = {}
+            if not(processing is None):
+                with timer.phase('processing'):
+                    final_values = { f'derived:{key}': val for key, val in PROCESSING.collect(processing, starttime).items() }
+            if(timer.totals):
+                final_values['derived:metadata/timing'] = (starttime, dict(timer.totals)) # the final write and finishing the point are only in the scan summary
+            if(final_values):
+                with timer.phase('put_values'):
+                    dm.putValues(final_values)
+            with timer.phase('finish_point'):
+                dm.finishPoint()
+            PHASE_TIMING.add(timer.totals)
+            model.record_point(timing_params, predicted_length, time.monotonic() - point_start)
+            return starttime
     except Exception as e:
-        import traceback
         session.log.warning(traceback.format_exc())
+    return None
+
+class SequenceUploader:
+    '''Uploads a pulse sequence to the spectrometer in a background thread, for pipelined scans.'''
+    def __init__(self, tnmr):
+        self.tnmr = tnmr
+        self.thread = None
+        self.error = None
+        self.duration = 0.0
+
+    def _upload(self, seq):
+        st = time.monotonic()
+        try:
+            UPLOAD_CACHE.upload_sequence(self.tnmr, seq)
+        except Exception as e:
+            self.error = e
+        self.duration = time.monotonic() - st
+
+    def start(self, seq):
+        self.error = None
+        self.thread = createThread('TNMR sequence upload', self._upload, args=(seq,))
+
+    def wait(self):
+        '''Waits for the upload to finish. Returns (time the upload took, time spent waiting for it here); raises if the upload failed.'''
+        st = time.monotonic()
+        self.thread.join()
+        self.thread = None
+        if not(self.error is None):
+            raise self.error
+        return self.duration, time.monotonic() - st
+
+def open_scan_journal(journal, sequence_list, sweep_values=None):
+    '''Opens the journal of a scan (a new one if journal is None), and checks what it says was completed against the scan files.
+    Returns the journal (None in dry runs), the point keys, the indices of the points still to be measured, and the files to resume into (or None).'''
+    N = len(sequence_list)
+    scan_journal = None
+    keys = None
+    if(session.mode != SIMULATION):
+        path = journal if not(journal is None) else new_journal_path()
+        if not(path is None):
+            scan_journal = ScanJournal(path)
+            keys = point_keys(sequence_list, sweep_values)
+            if(scan_journal.completed):
+                failed = scan_journal.verify() # from the file metadata only
+                if(failed):
+                    session.log.warning(f'{failed} journalled points are missing or incomplete in {scan_journal.files}, they will be measured again')
+            session.log.info(f'Scan journal: {path}')
+    todo = [ i for i in range(N) if (scan_journal is None) or not(scan_journal.is_done(keys[i])) ]
+    if(len(todo) < N):
+        session.log.info(f'Resuming scan: {N - len(todo)} of {N} points were completed already')
+    resume_files = scan_journal.files if not(scan_journal is None) and (scan_journal.completed) else None
+    if(resume_files) and not(TNMR_CURRENTLY_SCANNING is None):
+        session.log.warning('A scan file is open already, so the resumed points are written into it instead of the original file')
+    return scan_journal, keys, todo, resume_files
 
 @usercommand
-@helparglist('the reference name of the tnmr module, a list of pulse sequences to scan over, a list of (name, lambda) tuples to call (no argument) to be added to the save file')
-def scan_sequences(dev, sequence_list, additional_saving_lambdas={}):
+@helparglist('the reference name of the tnmr module, a list of pulse sequences to scan over, a list of (name, lambda) tuples to call (no argument) to be added to the save file, [pipelined], [journal file to resume]')
+def scan_sequences(dev, sequence_list, additional_saving_lambdas={}, pipelined=False, journal=None):
+    """
+    Scans over a list of pulse sequences (or a SequenceArray), writing every one of them as a point into the same file.
+    With pipelined=True, the next sequence is uploaded to the spectrometer while the current point is still being written out, so the host-side
+    work of two points overlaps. The file contents, and the order of the points, are the same as without.
+    Every completed point is noted in a journal file (a new one in the data root, unless the path of one is given as journal). If the scan is
+    interrupted, calling scan_sequences again with the same sequences and journal=<path> resumes it in the same file, skipping the completed points.
+    """
     global TNMR_CURRENTLY_SCANNING
     
     st = time.time()
     N = len(sequence_list)
     
-    initial_estimate = estimate_scan_length_from_device(dev, sequence_list)
+    scan_journal, keys, todo, resume_files = open_scan_journal(journal, sequence_list)
+    
+    eta = ScanETA(dev, sequence_list, get_timing_model(dev)) # (calibrated) per-sequence durations and their suffix sums, computed once
+    initial_estimate = eta.total() - sum(float(eta.durations[i]) for i in set(range(N)) - set(todo)) # without the completed points
     session.log.info(f'Beginning scan. ETA: {timestring(initial_estimate)}')
     
-    with tnmr_scan(): # Make sure that everything is put together in one file!
-        for i in range(N):
+    uploader = SequenceUploader(session.getDevice(dev))
+    saved = 0.0 # seconds of upload time hidden behind the write-out of the previous point
+    with tnmr_scan(resume_files): # Make sure that everything is put together in one file!
+        if not(scan_journal is None):
+            scan_journal.set_files(getattr(TNMR_CURRENT_DATASET, 'tnmr_files', []))
+        for j, i in enumerate(todo):
             seq = sequence_list[i]
-            etascan = timestring(estimate_scan_length_from_device(dev, sequence_list[i:]))
+            etascan = timestring(eta.refresh().remaining(i)) # only recomputed if the device parameters changed
             session.log.info(f'Beginning point {i+1}/{N}' + (f' ({float(i)/(N-1)*100:.0f}% complete)' if N>1 else ''))
             session.log.info(f'Scan ETA:  {etascan}')  
-            scan_sequence(dev, seq, additional_saving_lambdas)
+            if not(pipelined):
+                starttime = scan_sequence(dev, seq, additional_saving_lambdas)
+            else:
+                uploaded = False
+                if not(uploader.thread is None):
+                    try:
+                        upload_time, waited = uploader.wait()
+                        uploaded = True
+                        saved += upload_time - waited
+                        session.log.debug(f'Pipelined upload took {timestring(upload_time)}, of which {timestring(upload_time - waited)} overlapped with writing the previous point')
+                    except Exception:
+                        session.log.warning('Pipelined upload failed, uploading again', exc=1)
+                next_seq = sequence_list[todo[j+1]] if (j+1 < len(todo)) else None
+                starttime = scan_sequence(dev, seq, additional_saving_lambdas, uploaded=uploaded,
+                                          on_acquired=(lambda s=next_seq: uploader.start(s)) if not(next_seq is None) else None)
+            if not(scan_journal is None) and not(starttime is None):
+                scan_journal.record(keys[i], i, starttime)
+        if not(uploader.thread is None):
+            uploader.wait() # the scan was cut short. Do not leave the thread behind
       
     et = time.time()
     dt = et - st
+    if(pipelined) and (len(todo) > 1):
+        session.log.info(f'Pipelining saved {timestring(saved)} in total ({timestring(saved/(len(todo)-1))} per point, {saved/dt*100:.1f}% of the scan time)')
     
-    error = abs(dt - initial_estimate) / initial_estimate * 100.0
+    error = abs(dt - initial_estimate) / initial_estimate * 100.0 if initial_estimate > 0 else 0.0
     session.log.info(f'Finished scan. Took {timestring(dt)} (error of {error:.0f}% from initial estimate, {error/N:.0f}%/point, {timestring(error/N)} per point).')
     
+@usercommand
+@helparglist('the reference name of the tnmr module, a pulse sequence, the environment device to sweep, a list of setpoints, [tolerance], [settle time (s)], [timeout (s)], [dictionary of environment values to save], [journal file to resume]')
+def sweep_setpoints(dev, seq, env_dev, setpoints, tolerance=None, settle_time=0.0, timeout=None, additional_saving_lambdas={}, journal=None):
+    """
+    Measures the pulse sequence once per setpoint of an environment device (e.g., a magnet), all into the same file. This does the same as
+        for sp in setpoints:
+            maw(env_dev, sp)
+            scan_sequence(dev, seq)
+    except that the device is started towards the next setpoint as soon as an acquisition has finished, so that the ramp overlaps with reading
+    out and writing the point. Before the next acquisition starts, the device must have finished moving and, if a tolerance is given, its
+    readback must have stayed within tolerance of the setpoint for settle_time seconds (giving up after timeout seconds, if one is given).
+    Every entry gets the setpoint, the readback at the time of writing, the ramp time, and how much of it was not overlapped, as environment values.
+    Like scan_sequences, the completed points are journalled, and the sweep can be resumed with journal=<path>.
+    """
+    env = session.getDevice(env_dev)
+    N = len(setpoints)
+    mover = SetpointMover(env, tolerance, settle_time, timeout)
+    scan_journal, keys, todo, resume_files = open_scan_journal(journal, [ seq ]*N, setpoints)
+    
+    st = time.time()
+    eta = ScanETA(dev, [ seq ]*N, get_timing_model(dev))
+    session.log.info(f'Beginning sweep of {env} over {N} setpoints. ETA (without ramps): {timestring(eta.remaining(0))}')
+    hidden = 0.0 # seconds of ramping which overlapped with writing out the previous point
+    with tnmr_scan(resume_files):
+        if not(scan_journal is None):
+            scan_journal.set_files(getattr(TNMR_CURRENT_DATASET, 'tnmr_files', []))
+        for j, i in enumerate(todo):
+            if(mover.target != setpoints[i]):
+                # not started while the previous point was written out (the first point, or starting it failed there)
+                try:
+                    mover.start(setpoints[i])
+                except Exception:
+                    session.log.warning(f'Could not start {env} towards {setpoints[i]}, skipping point {i+1}/{N}. Traceback: \n{traceback.format_exc()}')
+                    continue # not journalled, so it is measured when the sweep is resumed
+            settled = mover.wait_settled()
+            if(j > 0):
+                hidden += mover.ramp_time - mover.settle_wait
+            session.log.info(f'Beginning point {i+1}/{N}: {env} at {setpoints[i]}' + ('' if settled else ' (not settled)'))
+            session.log.info(f'Scan ETA:  {timestring(eta.refresh().remaining(i))}')
+            saving = dict(additional_saving_lambdas)
+            saving[f'{env.name}_setpoint'] = (lambda sp=setpoints[i]: sp)
+            saving[f'{env.name}_readback'] = (lambda: env.read()) # read before the next ramp is started
+            saving[f'{env.name}_ramp_time'] = (lambda t=mover.ramp_time: t)
+            saving[f'{env.name}_settle_wait'] = (lambda t=mover.settle_wait: t)
+            saving[f'{env.name}_settled'] = (lambda b=settled: b)
+            next_sp = setpoints[todo[j+1]] if (j+1 < len(todo)) else None
+            starttime = scan_sequence(dev, seq, saving, on_acquired=(lambda sp=next_sp: mover.start(sp)) if not(next_sp is None) else None)
+            if not(scan_journal is None) and not(starttime is None):
+                scan_journal.record(keys[i], i, starttime)
+    
+    dt = time.time() - st
+    session.log.info(f'Finished sweep. Took {timestring(dt)}, of which {timestring(hidden)} of ramping overlapped with writing out points.')
+
+@usercommand
+@helparglist('the reference name of the tnmr module, a pulse sequence, pulse(s) whose delay is varied, shortest delay, longest delay, ["T1" or "T2"], [target relative precision of T], [maximum number of points], [processing settings, see set_processing]')
+def adaptive_relaxation_scan(dev, base_sequence, pulse_indices, delay_min, delay_max, model='T1', precision=0.05, max_points=40, n_initial=5,
+                             n_candidates=100, var_name='delay_time', time_factor=1.0, key='relaxation_fit', additional_saving_lambdas={}, **processing):
+    """
+    Measures a T1 (model="T1", y = a + b*exp(-delay/T)) or T2 (model="T2", y = b*exp(-delay/T)) relaxation curve, choosing the delays as it goes.
+    It starts with n_initial log-spaced delays between delay_min and delay_max. After every point, the intensity of the point is fitted together
+    with all previous ones. The next delay is the one of n_candidates log-spaced candidates that is expected to reduce the uncertainty of T the
+    most per second of measuring time. The scan stops once the relative error of T is at most precision, or after max_points points.
+    The intensity is taken from the processed FID (keyword arguments as for set_processing): the integral over integration=(f_min, f_max) if
+    given, otherwise the integral of the FID over echo_window=(t_min, t_max) (the whole FID if not given). Of the latter, T2 uses the magnitude;
+    T1, whose curve changes sign, uses the projection onto the phase of the first point.
+    Every entry gets the fit after its point (T, a, b, their errors, number of points...) under key, so the file holds the whole fit history.
+    Returns the last fit.
+    """
+    fitter = RelaxationFit(model, time_factor)
+    pulse_indices = as_index_list(pulse_indices)
+    candidates = log_durations(delay_min, delay_max, n_candidates)
+    costs = sequence_durations(timing_snapshot(dev), generate_sequences(base_sequence, pulse_indices, var_name, candidates, compact=True))
+    queue = log_durations(delay_min, delay_max, n_initial) if n_initial > 1 else [ delay_min ]
+    settings = dict(processing)
+    if(settings.get('integration', None) is None) and (settings.get('echo_window', None) is None):
+        settings['echo_window'] = (-math.inf, math.inf)
+    intensity_key = 'integrated_intensity' if not(settings.get('integration', None) is None) else 'echo_intensity'
+    signed = (model == 'T1') and (intensity_key == 'echo_intensity') # the magnitude would fold an inversion recovery at its zero crossing
+    reference = [] # phase of the echo of the first point
+    
+    def stage(point):
+        delay = point['sequence'][pulse_indices[0]][var_name]
+        out = fid_stage(point, **settings)
+        value = float(np.real(out[intensity_key]))
+        if(signed):
+            # the echo keeps its phase while its amplitude changes sign
+            if not(reference):
+                reference.append(float(out['echo_phase']))
+            value *= math.cos(math.radians(float(out['echo_phase']) - reference[0]))
+        fitter.add(delay, value)
+        res = fitter.fit()
+        ret = { 'delay': delay, 'intensity': fitter.values[-1], 'model': model }
+        if not(res is None):
+            ret.update(res)
+        return ret
+    
+    PROCESSING.add(key, stage)
+    res = None
+    try:
+        with tnmr_scan():
+            for n in range(max_points):
+                delay = queue.pop(0) if queue else fitter.next_delay(candidates, costs)
+                session.log.info(f'Adaptive {model} scan, point {n+1} (at most {max_points}): {var_name} = {delay:.4g}')
+                scan_sequence(dev, generate_sequences(base_sequence, pulse_indices, var_name, [ delay ])[0], additional_saving_lambdas)
+                res = fitter.result
+                if not(res is None):
+                    session.log.info(f'{model} = {res["T"]:.4g} +- {res["T_err"]:.2g} ({res["relative_error"]*100:.1f}%, {res["num_points"]} points)')
+                    if not(queue) and (res['relative_error'] <= precision):
+                        break
+    finally:
+        PROCESSING.remove(key)
+    return res
+
+@usercommand
+@helparglist('[key to write to], [window ("none", "exponential", "gaussian")], [line broadening], [zero-fill factor], [zero-order phase (deg)], [first-order phase (deg)], [integration window (f_min, f_max)], [echo window (t_min, t_max)]')
+def set_processing(key='tnmr_processed', window='exponential', line_broadening=0.0, zero_fill=2, phase0=0.0, phase1=0.0, integration=None, echo_window=None):
+    """
+    Processes the FID of every point that is measured from now on, and writes the result into the scan file under key (by default, the group
+    nmr_data/tnmr_processed next to the raw data): apodisation with the given window, zero-filling, FFT, phase correction, and optionally the
+    integral of the phased spectrum over a frequency window and the integral of the FID over a time window. Frequencies are in the inverse unit
+    of tnmr_times, as offsets from the receiver frequency. Calling it again with the same key replaces the settings.
+    The processing runs in worker threads while the point is being written out.
+    """
+    if not(window in WINDOWS):
+        raise ValueError(f'Unknown window {window}, should be one of {WINDOWS}')
+    PROCESSING.add(key, fid_stage, window=window, line_broadening=line_broadening, zero_fill=zero_fill, phase0=phase0, phase1=phase1,
+                   integration=integration, echo_window=echo_window)
+
+@usercommand
+@helparglist('key to write to, function taking the dictionary of a point (reals, imags, t, params, sequence) and keyword settings, [settings]')
+def add_processing_stage(key, func, **settings):
+    """
+    Adds a custom processing stage: func(point, **settings) is called on every point that is measured from now on, and what it returns is
+    written into the scan file under key.
+    """
+    PROCESSING.add(key, func, **settings)
+
+@usercommand
+@helparglist('[key of the stage to remove (all if not given)]')
+def clear_processing(key=None):
+    """
+    Stops processing the points (for one key, or all of them).
+    """
+    PROCESSING.remove(key)
+
 @usercommand
 @helparglist('the device whose parameters shoudl be updated, a dictionary of the parameters')
 def update_device_parameters(dev, dic):
-    for k,v in dic.items():
-        setattr(dev, k, v)
+    # only the parameters which actually differ from what the device has are written
+    UPLOAD_CACHE.set_params(session.getDevice(dev), dic)
+
+@usercommand
+@helparglist('[enabled]')
+def set_phase_timing(enabled=True):
+    """
+    Switches timing of the phases of every point (upload, compile_and_run, acquisition, read, params, environment, putValues, and the phases of
+    the NeXus sink) on or off. While on, every entry gets the breakdown in metadata/timing, and the 50th and 95th percentiles per phase are logged
+    and put into the cache at the end of every scan. While off, it costs (next to) nothing.
+    """
+    PHASE_TIMING.enabled = enabled
+    for sink in getattr(session, 'datasinks', []):
+        if('phase_timing' in sink.parameters):
+            sink.phase_timing = enabled
+
+@usercommand
+@parallel_safe
+def tnmr_upload_stats():
+    """
+    Shows how many sequence uploads and parameter writes to the spectrometer were sent, and how many were skipped because the device had the same values already.
+    """
+    s = UPLOAD_CACHE.stats
+    session.log.info(f'Sequences: {s["sequence_uploads"]} uploaded, {s["sequence_skips"]} skipped. Parameters: {s["param_writes"]} written, {s["param_skips"]} skipped.')
+    return dict(s)
+
+@usercommand
+@parallel_safe
+def tnmr_reset_upload_cache():
+    """
+    Forgets which sequences were uploaded, so that the next one is sent to the spectrometer in any case.
+    """
+    UPLOAD_CACHE.invalidate()
@@ -0,0 +1,210 @@
+# *****************************************************************************
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Davis V. Garrad <davis.last@psi.ch>
+#
+# *****************************************************************************
+
+# Duration estimates for pulse sequences and whole scans, and a model correcting them from measured timings.
+
+import json
+import os
+
+import numpy as np
+
+from nicos import session
+
+from nicos_sinq.tnmr.commands.tnmr_sequences import SequenceArray
+
+TIMING_PARAMS = ('acquisition_time', 'pre_acquisition_time', 'post_acquisition_time', 'num_acqs')
+
+def timing_snapshot(dev):
+    '''The device parameters the duration of a sequence depends on, read once.'''
+    tnmr = session.getDevice(dev)
+    return { k: getattr(tnmr, k) for k in TIMING_PARAMS }
+
+def pulse_durations(sequences):
+    '''Sum of delay times and pulse widths (us) of each sequence, as an array. Takes a SequenceArray or a list of sequences in dictionary form.'''
+    if(isinstance(sequences, SequenceArray)):
+        return sequences.pulse_durations()
+    return np.array([ sum(p['delay_time'] + p['pulse_width'] for p in seq) for seq in sequences ], dtype=float)
+
+def sequence_durations(params, sequences):
+    '''Estimated duration (s) of each sequence, given the timing parameters (see TIMING_PARAMS). Returns an array.'''
+    per_acq = params['acquisition_time']*1e-6 + params['pre_acquisition_time']*1e-6 + params['post_acquisition_time']*1e-3
+    return (pulse_durations(sequences)*1e-6 + per_acq) * params['num_acqs']
+
+class ScanETA:
+    '''Remaining-time estimates for a list of sequences that is scanned in order.
+    The durations are computed once (vectorised) from a single snapshot of the device parameters, and kept as suffix sums, so that
+    remaining(i) is a lookup. refresh() takes a new snapshot and only recomputes if the parameters have changed.
+    If a TimingModel is given, the durations are calibrated with it, and its per-scan overhead is added to the total.'''
+    def __init__(self, dev, sequences, model=None):
+        self.dev = dev
+        self.sequences = sequences
+        self.model = model
+        self.params = None
+        self.durations = None
+        self.suffix = None
+        self.refresh()
+
+    def refresh(self):
+        params = timing_snapshot(self.dev)
+        if(params != self.params):
+            self.params = params
+            self.durations = sequence_durations(params, self.sequences)
+            if not(self.model is None):
+                self.durations = self.model.calibrate(params, self.durations)
+            self.suffix = np.append(np.cumsum(self.durations[::-1])[::-1], 0.0)
+        return self
+
+    def total(self):
+        return float(self.suffix[0]) + (self.model.per_scan() if not(self.model is None) else 0.0)
+
+    def remaining(self, i):
+        '''Estimated time (s) for sequences i, i+1, ... to the end.'''
+        return float(self.suffix[i])
+
+class _LinearFit:
+    '''Running sums for a least-squares fit of y = slope*x + offset, so that samples do not have to be kept.'''
+    def __init__(self, sums=None):
+        self.n, self.sx, self.sy, self.sxx, self.sxy = sums if sums else (0, 0.0, 0.0, 0.0, 0.0)
+
+    def add(self, x, y):
+        self.n += 1
+        self.sx += x
+        self.sy += y
+        self.sxx += x*x
+        self.sxy += x*y
+
+    def mean(self):
+        return self.sy / self.n if self.n else 0.0
+
+    def coefficients(self):
+        '''(slope, offset). The slope is zero unless there are at least 3 samples whose x differ noticeably.'''
+        if(self.n == 0):
+            return 0.0, 0.0
+        var = self.sxx/self.n - (self.sx/self.n)**2
+        mean_x = self.sx / self.n
+        if(self.n < 3) or (var <= (0.1*mean_x)**2) or (var <= 0):
+            return 0.0, self.mean()
+        slope = (self.sxy/self.n - mean_x*self.sy/self.n) / var
+        return slope, self.sy/self.n - slope*mean_x
+
+    def sums(self):
+        return [ self.n, self.sx, self.sy, self.sxx, self.sxy ]
+
+class TimingModel:
+    '''Learns how long points and scans really take, compared to sequence_durations.
+    For every point, the overhead (measured - predicted) is recorded, grouped by the device parameters (num_acqs, acquisition_time, post_acquisition_time).
+    Within a group the overhead is fitted as a linear function of the prediction (e.g., readout that scales with the number of acquisitions, plus
+    compile/upload/sink time per point). Groups that have not been measured yet fall back to a fit over all points of overhead vs. num_acqs.
+    The time spent in a scan outside of its points is averaged as a per-scan overhead. Everything is kept as running sums and stored as JSON.'''
+    VERSION = 1
+
+    def __init__(self, path=None):
+        self.path = path
+        self.groups = {}
+        self.overall = _LinearFit()
+        self.scan_overhead = _LinearFit()
+        self._scan_points_time = 0.0
+        self._scan_points = 0
+        if not(path is None):
+            self.load()
+
+    @staticmethod
+    def group_key(params):
+        return f'{params["num_acqs"]}|{params["acquisition_time"]}|{params["post_acquisition_time"]}'
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                d = json.load(f)
+        except (OSError, ValueError):
+            return # nothing learned yet
+        if(d.get('version', None) != self.VERSION):
+            return
+        self.groups = { k: _LinearFit(v) for k, v in d['groups'].items() }
+        self.overall = _LinearFit(d['overall'])
+        self.scan_overhead = _LinearFit(d['scan_overhead'])
+
+    def save(self):
+        if(self.path is None):
+            return
+        d = { 'version': self.VERSION,
+              'groups': { k: v.sums() for k, v in self.groups.items() },
+              'overall': self.overall.sums(),
+              'scan_overhead': self.scan_overhead.sums() }
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(d, f)
+        os.replace(tmp, self.path)
+
+    def record_point(self, params, predicted, measured):
+        overhead = measured - predicted
+        self.groups.setdefault(self.group_key(params), _LinearFit()).add(predicted, overhead)
+        self.overall.add(float(params['num_acqs']), overhead)
+        self._scan_points_time += measured
+        self._scan_points += 1
+
+    def begin_scan(self):
+        self._scan_points_time = 0.0
+        self._scan_points = 0
+
+    def end_scan(self, measured):
+        '''measured is the duration of the whole scan. Whatever was not spent in points counts as per-scan overhead (if any point was recorded).'''
+        if(self._scan_points > 0):
+            self.scan_overhead.add(0.0, max(0.0, measured - self._scan_points_time))
+
+    def calibrate(self, params, predicted):
+        '''Calibrated point durations (s) for an array (or single value) of predicted durations with the given parameters.'''
+        predicted = np.asarray(predicted, dtype=float)
+        group = self.groups.get(self.group_key(params), None)
+        if not(group is None):
+            slope, offset = group.coefficients()
+            return predicted + slope*predicted + offset
+        if(self.overall.n > 0):
+            slope, offset = self.overall.coefficients()
+            return predicted + slope*params['num_acqs'] + offset
+        return predicted
+
+    def per_scan(self):
+        return self.scan_overhead.mean()
+
+_TIMING_MODELS = {} # None (the real module), or (name, time_scale) of a simulated device -> TimingModel
+
+def get_timing_model(dev=None):
+    '''The timing model of this session, loaded from (and saved to) the data root of the experiment, if there is one.
+    A simulated device (time_scale) gets one of its own per time_scale, which is not saved, so that it does not distort the real estimates.'''
+    key = None
+    if not(dev is None):
+        tnmr = session.getDevice(dev)
+        if(hasattr(tnmr, 'time_scale')):
+            key = (tnmr.name, tnmr.time_scale)
+    if not(key in _TIMING_MODELS):
+        path = None
+        if(key is None):
+            try:
+                path = os.path.join(session.experiment.dataroot, 'tnmr_timing_model.json')
+            except Exception:
+                pass
+        _TIMING_MODELS[key] = TimingModel(path)
+    return _TIMING_MODELS[key]
+
+def timing_models():
+    '''All timing models used in this session so far.'''
+    return list(_TIMING_MODELS.values())
@@ -0,0 +1,136 @@
+# *****************************************************************************
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Davis V. Garrad <davis.last@psi.ch>
+#
+# *****************************************************************************
+
+# Journal of the completed points of a scan, so that an interrupted scan can be resumed into the same file.
+
+import datetime
+import json
+import os
+
+import h5py as hdf
+
+from nicos import session
+
+from nicos_sinq.tnmr.commands.tnmr_upload import content_hash
+from nicos_sinq.tnmr.sinks.HDF5_NEXUS import EntryIndex
+
+def point_keys(sequences, sweep_values=None):
+    '''One key per point: the hash of the sequence (and of the sweep value, if there is one), plus how many identical points came before it,
+    so that repeated points are told apart.'''
+    seen = {}
+    keys = []
+    for i in range(len(sequences)):
+        h = content_hash([ sequences[i], None if sweep_values is None else sweep_values[i] ])
+        n = seen.get(h, 0)
+        seen[h] = n + 1
+        keys += [ f'{h}#{n}' ]
+    return keys
+
+def entry_iso(starttime):
+    '''The entry start time that the HDF5 NeXus sink writes for a point which started at starttime (UNIX time).'''
+    return str(datetime.datetime.fromtimestamp(starttime).astimezone().isoformat())
+
+def new_journal_path():
+    '''A fresh journal file in the data root of the experiment, or None if there is no data root.'''
+    try:
+        return os.path.join(session.experiment.dataroot, 'tnmr_journals', f'scan_{datetime.datetime.now():%Y%m%d-%H%M%S}.jsonl')
+    except Exception:
+        return None
+
+class ScanJournal:
+    '''Append-only JSON-lines file: a line with the paths of the scan files, then one line per completed point ({"key", "index", "start"}).
+    Every line is synced to disk before the next point starts, so a crash loses at most the point that was being measured.'''
+    def __init__(self, path):
+        self.path = path
+        self.files = []
+        self.completed = {} # point key -> record
+        if(os.path.exists(path)):
+            self._load()
+
+    def _load(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue # the last line may have been cut short by the crash
+                if('files' in rec):
+                    self.files = rec['files']
+                elif('key' in rec):
+                    self.completed[rec['key']] = rec
+
+    def _append(self, rec):
+        d = os.path.dirname(self.path)
+        if(d):
+            os.makedirs(d, exist_ok=True)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(rec) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def set_files(self, files):
+        if(list(files) != self.files):
+            self.files = list(files)
+            self._append({ 'files': self.files })
+
+    def is_done(self, key):
+        return key in self.completed
+
+    def record(self, key, index, starttime):
+        rec = { 'key': key, 'index': index, 'start': starttime }
+        self.completed[key] = rec
+        self._append(rec)
+
+    def verify(self):
+        '''Checks, in every scan file, that the entry of each completed point exists and has a non-empty signal. Only the entry start times and the
+        dataset shapes are looked at; no data is read. Points which fail are forgotten (so they are measured again), as are all points if the journal
+        has no scan files (nothing was written anywhere) or a file cannot be read. Returns the number of failed points.'''
+        good = set(self.completed.keys()) if (self.files) else set()
+        for path in self.files:
+            if not(os.path.exists(path)):
+                good = set()
+                break
+            try:
+                try:
+                    file = hdf.File(path, 'r')
+                except OSError:
+                    file = hdf.File(path, 'r', swmr=True, libver='latest') # written with swmr and not closed, see the swmr parameter of the sink
+                with file:
+                    index = EntryIndex(file)
+                    for key in list(good):
+                        name = index.by_time.get(entry_iso(self.completed[key]['start']), None)
+                        if(name is None) or not('nmr_data' in file[name]):
+                            good.discard(key)
+                            continue
+                        data = file[name]['nmr_data']
+                        signal = data.attrs.get('signal', b'')
+                        signal = signal.decode('utf-8') if isinstance(signal, bytes) else str(signal)
+                        if not(signal in data) or (data[signal].size == 0):
+                            good.discard(key)
+            except OSError:
+                session.log.warning(f'Could not read {path} to check the scan journal, its points will be measured again', exc=1)
+                good = set() # every point goes into every file
+                break
+        failed = len(self.completed) - len(good)
+        self.completed = { k: v for k, v in self.completed.items() if k in good }
+        if not(self.completed):
+            self.files = [] # nothing to resume into; start a new file
+        return failed
@@ -0,0 +1,123 @@
+# *****************************************************************************
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Davis V. Garrad <davis.last@psi.ch>
+#
+# *****************************************************************************
+
+# On-the-fly processing of the FIDs (apodisation, zero-filling, FFT, phasing, integration), written into the scan file next to the raw data.
+
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from nicos import session
+
+WINDOWS = ('none', 'exponential', 'gaussian')
+
+def process_fid(t, fid, window='exponential', line_broadening=0.0, zero_fill=2, phase0=0.0, phase1=0.0, integration=None, echo_window=None):
+    '''Processes one FID, or a stack of them (time along the last axis), in a few whole-array operations.
+    t is the (evenly spaced) time axis; frequencies come out in the inverse unit (Hz if t is in s, MHz if t is in us), as offsets from the receiver frequency.
+    window: 'none', 'exponential' (exp(-pi*lb*t)) or 'gaussian' (exp(-(pi*lb*t)^2/(4 ln 2))), with lb = line_broadening (in the unit of the frequencies).
+    zero_fill: the FID is padded with zeros to zero_fill times its length (rounded up to a power of two).
+    phase0, phase1: zero- and first-order phase correction (degrees); the first-order one is phase1*f/(spectral width), pivoting at zero offset.
+    integration: (f_min, f_max), window over which the real part of the phased spectrum is integrated.
+    echo_window: (t_min, t_max), window over which the (apodised) FID is integrated in the time domain, e.g., for echo intensities.
+    Returns a dictionary with frequencies, spectrum_reals, spectrum_imags, and, if requested, integrated_intensity, and echo_intensity and echo_phase
+    (magnitude and phase in degrees of the integral over echo_window).'''
+    t = np.asarray(t, dtype=np.float64)
+    fid = np.asarray(fid)
+    n = fid.shape[-1]
+    dt = (t[-1] - t[0])/(n - 1) if (n > 1) else 1.0
+    t0 = t[0]
+    t = t - t0 # the window starts with the FID
+    
+    if(window == 'exponential'):
+        fid = fid*np.exp(-np.pi*line_broadening*t)
+    elif(window == 'gaussian'):
+        fid = fid*np.exp(-(np.pi*line_broadening*t)**2/(4*np.log(2)))
+    elif(window != 'none'):
+        raise ValueError(f'Unknown window {window}, should be one of {WINDOWS}')
+    
+    nfft = 1 << int(np.ceil(np.log2(max(1, n*max(1, zero_fill)))))
+    spectrum = np.fft.fftshift(np.fft.fft(fid, n=nfft, axis=-1), axes=-1)
+    freqs = np.fft.fftshift(np.fft.fftfreq(nfft, d=dt))
+    sw = 1.0/dt
+    spectrum = spectrum*np.exp(-1j*np.deg2rad(phase0 + phase1*freqs/sw))
+    
+    ret = { 'frequencies': freqs, 'spectrum_reals': spectrum.real, 'spectrum_imags': spectrum.imag }
+    if not(integration is None):
+        mask = (freqs >= integration[0]) & (freqs <= integration[1])
+        ret['integrated_intensity'] = spectrum.real[..., mask].sum(axis=-1)*(sw/nfft)
+    if not(echo_window is None):
+        mask = (t + t0 >= echo_window[0]) & (t + t0 <= echo_window[1])
+        echo = fid[..., mask].sum(axis=-1)*dt
+        ret['echo_intensity'] = np.abs(echo)
+        ret['echo_phase'] = np.rad2deg(np.angle(echo))
+    return ret
+
+def fid_stage(point, **settings):
+    '''The standard stage: processes the FID of a point (see process_fid).'''
+    fid = np.asarray(point['reals']) + 1j*np.asarray(point['imags'])
+    return process_fid(point['t'], fid, **settings)
+
+class ProcessingPipeline:
+    '''Per sink key, a function which derives values from a completed point. The functions are called with a dictionary of the point
+    (reals, imags, t, params, sequence) and the keyword settings they were added with, and return what is written under their key
+    (a dictionary becomes a group, e.g., nmr_data/tnmr_processed/spectrum_reals). They run in a pool of worker threads, so that they overlap with
+    the final write-out of the point (and whatever else happens after the acquisition); scan_sequence collects the results before it finishes the point.'''
+    def __init__(self, workers=2):
+        self.stages = {} # sink key -> (function, settings)
+        self.workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def add(self, key, func, **settings):
+        with self._lock:
+            self.stages[key] = (func, settings)
+
+    def remove(self, key=None):
+        with self._lock:
+            if(key is None):
+                self.stages = {}
+            else:
+                self.stages.pop(key, None)
+
+    def submit(self, point):
+        '''Starts all stages on the point. Returns what collect needs, or None if there is nothing to do.'''
+        with self._lock:
+            stages = dict(self.stages)
+        if not(stages):
+            return None
+        if(self._pool is None):
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='TNMR processing')
+        return { key: self._pool.submit(func, point, **settings) for key, (func, settings) in stages.items() }
+
+    def collect(self, futures, timestamp):
+        '''Waits for the stages started by submit, and returns their results as values for the data manager ({key: (timestamp, value)}).
+        A stage which fails is logged and left out.'''
+        ret = {}
+        for key, fut in futures.items():
+            try:
+                ret[key] = (timestamp, fut.result())
+            except Exception:
+                session.log.warning(f'Processing stage `{key}` failed. Traceback: \n{traceback.format_exc()}')
+        return ret
+
+PROCESSING = ProcessingPipeline()
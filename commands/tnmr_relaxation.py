@@ -0,0 +1,153 @@
+# *****************************************************************************
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Davis V. Garrad <davis.last@psi.ch>
+#
+# *****************************************************************************
+
+# Incremental fitting of relaxation curves (T1, T2), and choosing the delay that constrains the fit best for the time it costs.
+
+import threading
+
+import numpy as np
+
+MODELS = { 'T1': True, 'T2': False } # model -> whether it has an offset. y = offset + amplitude*exp(-delay/T)
+
+class RelaxationFit:
+    '''Fits y = a + b*exp(-delay/T) (T1; a = 0 for T2) to the points added so far.
+    The fit first evaluates a log-spaced grid of T in one go (for a fixed T the model is linear, so a and b follow in closed form), and then refines
+    the best grid value with a few Gauss-Newton steps, which also give the covariance of (a, b, T).
+    delays are multiplied by time_factor before fitting (e.g., 2 for a Hahn echo whose swept delay is half the echo time).'''
+    def __init__(self, model='T1', time_factor=1.0, grid_points=200):
+        if not(model in MODELS):
+            raise ValueError(f'Unknown relaxation model {model}, should be one of {tuple(MODELS)}')
+        self.model = model
+        self.offset = MODELS[model]
+        self.time_factor = time_factor
+        self.grid_points = grid_points
+        self.delays = []
+        self.values = []
+        self.result = None # last result of fit()
+        self.history = [] # every result of fit(), in order
+        self._cov = None
+        self._theta = None
+        self._lock = threading.Lock()
+
+    def nparams(self):
+        return 3 if self.offset else 2
+
+    def add(self, delay, value):
+        with self._lock:
+            self.delays += [ float(delay) ]
+            self.values += [ float(value) ]
+
+    def _jacobian(self, tau, a, b, T):
+        '''Derivatives of the model by (a, b, T) (without a if there is no offset), one row per delay.'''
+        e = np.exp(-tau/T)
+        cols = [ e, b*tau/T**2*e ]
+        if(self.offset):
+            cols = [ np.ones_like(tau) ] + cols
+        return np.stack(cols, axis=-1)
+
+    def _linear(self, tau, y, T):
+        '''Best a, b (vectorised over an array of T), and the residual sum of squares.'''
+        E = np.exp(-tau[None, :]/T[:, None])
+        n = len(tau)
+        Se, See, Sy, Sey = E.sum(axis=1), (E*E).sum(axis=1), y.sum(), (E*y[None, :]).sum(axis=1)
+        if(self.offset):
+            det = n*See - Se**2
+            det = np.where(np.abs(det) > 1e-300, det, np.inf)
+            b = (n*Sey - Se*Sy)/det
+            a = (Sy - b*Se)/n
+        else:
+            b = Sey/np.where(See > 0, See, np.inf)
+            a = np.zeros_like(b)
+        rss = ((y[None, :] - a[:, None] - b[:, None]*E)**2).sum(axis=1)
+        return a, b, rss
+
+    def fit(self, iterations=10):
+        '''Fits the points so far. Returns (and keeps as result) a dictionary with T, a, b, their errors, the relative error of T, the residual sum
+        of squares, and the number of points; or None if there are too few points to say anything.'''
+        with self._lock:
+            tau = np.array(self.delays)*self.time_factor
+            y = np.array(self.values)
+        p = self.nparams()
+        if(len(tau) < p) or (np.ptp(tau) <= 0):
+            return None
+        
+        lo, hi = tau[tau > 0].min() if np.any(tau > 0) else 1.0, tau.max()
+        grid = np.geomspace(lo/10, hi*10, self.grid_points)
+        a, b, rss = self._linear(tau, y, grid)
+        best = int(np.argmin(rss))
+        theta = np.array(([a[best]] if self.offset else []) + [ b[best], grid[best] ])
+        
+        def unpack(theta):
+            return (theta[0], theta[1], theta[2]) if self.offset else (0.0, theta[0], theta[1])
+        def residual(theta):
+            a, b, T = unpack(theta)
+            return y - (a + b*np.exp(-tau/T))
+        
+        r = residual(theta)
+        for i in range(iterations):
+            J = self._jacobian(tau, *unpack(theta))
+            step = np.linalg.lstsq(J, r, rcond=None)[0]
+            new = theta + step
+            if(unpack(new)[2] <= 0):
+                break
+            rn = residual(new)
+            if((rn**2).sum() > (r**2).sum()):
+                break # Gauss-Newton overshot; the grid value (or the last step) is as good as it gets
+            theta, r = new, rn
+        
+        a, b, T = unpack(theta)
+        rss = float((r**2).sum())
+        J = self._jacobian(tau, a, b, T)
+        cov = None
+        if(len(tau) > p):
+            try:
+                cov = np.linalg.inv(J.T @ J)*(rss/(len(tau) - p))
+            except np.linalg.LinAlgError:
+                cov = None
+        err = np.sqrt(np.abs(np.diag(cov))) if not(cov is None) else np.full(p, np.inf)
+        errs = unpack(err) if self.offset else (0.0, err[0], err[1])
+        res = { 'T': T, 'a': a, 'b': b, 'T_err': errs[2], 'a_err': errs[0], 'b_err': errs[1],
+                'relative_error': errs[2]/abs(T) if T != 0 else np.inf, 'rss': rss, 'num_points': len(tau) }
+        self._cov = cov
+        self._theta = (a, b, T)
+        with self._lock:
+            self.result = res
+            self.history += [ res ]
+        return res
+
+    def next_delay(self, candidates, costs=None):
+        '''The candidate delay which is expected to reduce the variance of T the most per second it costs (costs: duration of a point with each
+        candidate delay; all equal if not given). Without a usable fit, the candidate farthest (on a log scale) from all measured delays.'''
+        candidates = np.asarray(candidates, dtype=np.float64)
+        costs = np.ones_like(candidates) if (costs is None) else np.maximum(np.asarray(costs, dtype=np.float64), 1e-9)
+        if(self.result is None) or (self._cov is None) or not(np.all(np.isfinite(self._cov))):
+            if not(self.delays):
+                return float(candidates[0])
+            dist = np.abs(np.log(candidates[:, None]) - np.log(np.maximum(np.array(self.delays), 1e-300))[None, :]).min(axis=1)
+            return float(candidates[int(np.argmax(dist))])
+        a, b, T = self._theta
+        C = self._cov
+        sigma2 = self.result['rss']/max(1, self.result['num_points'] - self.nparams())
+        J = self._jacobian(candidates*self.time_factor, a, b, T) # one row per candidate
+        CJ = J @ C # (C j) for every candidate, C is symmetric
+        # Sherman-Morrison: the variance of T after adding a point at each candidate, all at once
+        reduction = CJ[:, -1]**2/(sigma2 + (CJ*J).sum(axis=1))
+        return float(candidates[int(np.argmax(reduction/costs))])
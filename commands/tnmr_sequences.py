@@ -0,0 +1,125 @@
+# *****************************************************************************
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Davis V. Garrad <davis.last@psi.ch>
+#
+# *****************************************************************************
+
+# A compact representation of many pulse sequences at once: one NumPy structured array of shape (number of sequences, number of pulses).
+# The dictionary form (a list of { 'pulse_width', 'pulse_height', 'delay_time', 'phase_cycle' } per sequence), which is what tnmr.sequence_data
+# wants, is only created when a single sequence is taken out of it.
+
+import math
+
+import numpy as np
+
+PULSE_FIELDS = ('pulse_width', 'pulse_height', 'delay_time', 'phase_cycle')
+PULSE_DTYPE = np.dtype([ ('pulse_width', 'f8'), ('pulse_height', 'f8'), ('delay_time', 'f8'), ('phase_cycle', 'O') ])
+
+def as_index_list(pulse_indices):
+    '''Accepts a single pulse index, or any iterable of them.'''
+    try:
+        return list(pulse_indices)
+    except TypeError:
+        return [ pulse_indices ]
+
+def pulses_from_dicts(seq):
+    '''Converts one pulse sequence (list of pulse dictionaries) into a structured array of shape (number of pulses,).'''
+    pulses = np.empty(len(seq), dtype=PULSE_DTYPE)
+    for i, p in enumerate(seq):
+        extra = set(p.keys()) - set(PULSE_FIELDS)
+        if(extra):
+            raise ValueError(f'pulse {i} has keys that cannot be stored compactly: {sorted(extra)}')
+        pulses[i] = tuple(p[k] for k in PULSE_FIELDS)
+    return pulses
+
+def pulses_to_dicts(pulses):
+    '''Converts a structured array of shape (number of pulses,) into a pulse sequence (list of pulse dictionaries), with plain Python values.'''
+    return [ dict(zip(PULSE_FIELDS, p)) for p in pulses.tolist() ]
+
+class SequenceArray:
+    '''Many pulse sequences with the same number of pulses, stored as one structured array (pulses, shape (N, number of pulses)).
+    coords holds the swept values per sequence (name -> array of length N), if it was made by sweep_grid.
+    Indexing with an integer gives the dictionary form of that sequence; slices (and index arrays) give another SequenceArray.
+    Whole columns can be changed at once, e.g. seqs.pulses['delay_time'][:, 1] = seqs.pulses['delay_time'][:, 0] - 10.0'''
+    __slots__ = ('pulses', 'coords')
+
+    def __init__(self, pulses, coords=None):
+        self.pulses = pulses
+        self.coords = coords if not(coords is None) else {}
+
+    @classmethod
+    def from_sequences(cls, sequences):
+        '''From a list of pulse sequences in dictionary form.'''
+        if(len(sequences) == 0):
+            return cls(np.empty((0, 0), dtype=PULSE_DTYPE))
+        return cls(np.stack([ pulses_from_dicts(seq) for seq in sequences ]))
+
+    def __len__(self):
+        return self.pulses.shape[0]
+
+    def __getitem__(self, i):
+        if(isinstance(i, (int, np.integer))):
+            return pulses_to_dicts(self.pulses[i])
+        return SequenceArray(self.pulses[i], { k: v[i] for k, v in self.coords.items() })
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_list(self):
+        '''The dictionary form of all sequences, as generate_sequences has always returned it.'''
+        return [ pulses_to_dicts(p) for p in self.pulses ]
+
+    def pulse_durations(self):
+        '''Sum of the delay times and pulse widths of each sequence (us), as an array of length N.'''
+        return self.pulses['delay_time'].sum(axis=1) + self.pulses['pulse_width'].sum(axis=1)
+
+def coord_name(pulse_indices, var_name):
+    return f'{var_name}[{",".join(str(i) for i in pulse_indices)}]'
+
+def sweep_grid(base_sequence, sweeps, mode='product'):
+    '''Builds a SequenceArray from a base sequence (dictionary form) and a list of sweeps, each (pulse indices, variable name, values).
+    mode 'product' gives every combination of the sweep values (the last sweep varies fastest), mode 'zip' steps through all sweeps together (they must have the same length).
+    No per-sequence copies are made: the base is repeated once into the (N, number of pulses) array and each sweep is assigned as a whole column.'''
+    base = pulses_from_dicts(base_sequence)
+    sweeps = [ (as_index_list(idx), var_name, np.asarray(vals)) for (idx, var_name, vals) in sweeps ]
+    for idx, var_name, vals in sweeps:
+        if not(var_name in PULSE_FIELDS):
+            raise ValueError(f'cannot sweep {var_name!r}, use one of {PULSE_FIELDS}')
+    if(len(sweeps) == 0):
+        return SequenceArray(base[np.newaxis, :].copy())
+
+    if(mode == 'product'):
+        shape = tuple(len(vals) for (_, _, vals) in sweeps)
+        n = math.prod(shape)
+        positions = np.unravel_index(np.arange(n), shape)
+    elif(mode == 'zip'):
+        n = len(sweeps[0][2])
+        if any(len(vals) != n for (_, _, vals) in sweeps):
+            raise ValueError('all sweeps must have the same number of values in zip mode')
+        positions = [ np.arange(n) ]*len(sweeps)
+    else:
+        raise ValueError(f'unknown sweep mode {mode!r}, use "product" or "zip"')
+
+    pulses = np.repeat(base[np.newaxis, :], n, axis=0)
+    coords = {}
+    for (idx, var_name, vals), pos in zip(sweeps, positions):
+        column = vals[pos]
+        pulses[var_name][:, idx] = column[:, np.newaxis]
+        coords[coord_name(idx, var_name)] = column
+    return SequenceArray(pulses, coords)
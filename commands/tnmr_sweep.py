@@ -0,0 +1,79 @@
+# *****************************************************************************
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Davis V. Garrad <davis.last@psi.ch>
+#
+# *****************************************************************************
+
+# Moving an environment device (magnet, temperature...) to the next setpoint of a sweep while the current point is still being written out.
+
+import time
+
+from nicos import session
+from nicos.core import SIMULATION
+
+class SetpointMover:
+    '''Starts an environment device towards a setpoint, and later waits until it has settled there.
+    The device has settled once it reports that it has finished moving and, if a tolerance is given, its readback has stayed within tolerance of the
+    setpoint for settle_time seconds. If that does not happen within timeout seconds (None: no limit), a warning is logged and the sweep carries on.
+    start() returns immediately, so it can be called as soon as an acquisition has finished (see on_acquired of scan_sequence).'''
+    def __init__(self, dev, tolerance=None, settle_time=0.0, timeout=None, poll_interval=0.2):
+        self.dev = dev
+        self.tolerance = tolerance
+        self.settle_time = settle_time
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.target = None
+        self.started_at = None
+        self.ramp_time = 0.0 # seconds from start() until the device had settled
+        self.settle_wait = 0.0 # of those, the seconds spent in wait_settled (i.e., not overlapped with anything else)
+
+    def start(self, target):
+        '''Starts the device towards target. If the device refuses (e.g. the target is out of its limits), this raises and target is left unset.'''
+        self.target = None
+        self.started_at = time.monotonic()
+        self.dev.start(target)
+        self.target = target
+
+    def _in_tolerance(self):
+        return abs(self.dev.read(0) - self.target) <= self.tolerance
+
+    def wait_settled(self):
+        '''Blocks until the device has settled at the last target. Returns True if it did, False if the timeout ran out first.'''
+        t0 = time.monotonic()
+        self.dev.wait()
+        settled = True
+        if not(self.tolerance is None) and (session.mode != SIMULATION):
+            stable_since = None
+            while True:
+                now = time.monotonic()
+                if(self._in_tolerance()):
+                    if(stable_since is None):
+                        stable_since = now
+                    if(now - stable_since >= self.settle_time):
+                        break
+                else:
+                    stable_since = None
+                if not(self.timeout is None) and (now - t0 > self.timeout):
+                    session.log.warning(f'{self.dev} did not settle within {self.tolerance} of {self.target} in {self.timeout} s, carrying on')
+                    settled = False
+                    break
+                session.delay(self.poll_interval)
+        now = time.monotonic()
+        self.settle_wait = now - t0
+        self.ramp_time = now - self.started_at
+        return settled
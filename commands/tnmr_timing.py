@@ -0,0 +1,99 @@
+# *****************************************************************************
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Davis V. Garrad <davis.last@psi.ch>
+#
+# *****************************************************************************
+
+# Where the time of a point goes: monotonic timers per phase (upload, acquisition, read...), and their percentiles over a scan.
+
+import time
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+from nicos import session
+
+class PhaseTimer:
+    '''Adds up the time spent in each named phase of one point.'''
+    def __init__(self):
+        self.totals = {} # phase -> seconds
+
+    @contextmanager
+    def phase(self, name):
+        t0 = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - t0)
+
+    def add(self, name, seconds):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+class NullTimer:
+    '''Stands in for a PhaseTimer when timing is off; every call is (nearly) free.'''
+    totals = {}
+    _null = nullcontext()
+
+    def phase(self, name):
+        return self._null
+
+    def add(self, name, seconds):
+        pass
+
+NULL_TIMER = NullTimer()
+
+class TimingStats:
+    '''Collects the phase breakdowns of the points of a scan, and summarises them as percentiles.'''
+    def __init__(self):
+        self.enabled = False
+        self.points = []
+
+    def timer(self):
+        return PhaseTimer() if self.enabled else NULL_TIMER
+
+    def add(self, totals):
+        if(totals):
+            self.points += [ dict(totals) ]
+
+    def summary(self, percentiles=(50, 95)):
+        '''{phase: {"p50": seconds, "p95": seconds, "total": seconds}} over the points so far (a phase missing from a point counts as 0).'''
+        if not(self.points):
+            return {}
+        phases = sorted(set().union(*self.points))
+        times = np.array([ [ p.get(ph, 0.0) for ph in phases ] for p in self.points ]) # (points, phases)
+        pct = np.percentile(times, percentiles, axis=0)
+        return { ph: dict([ (f'p{q}', float(pct[i, j])) for i, q in enumerate(percentiles) ] + [ ('total', float(times[:, j].sum())) ])
+                 for j, ph in enumerate(phases) }
+
+    def publish(self, cache_key='tnmr/phase_timing'):
+        '''Logs the summary of the scan, puts it into the NICOS cache (under cache_key), and starts over.'''
+        summary = self.summary()
+        if(summary):
+            session.log.info(f'Time per point by phase, over {len(self.points)} points:')
+            session.log.info(f'{"phase":<20}{"p50 (ms)":>10}{"p95 (ms)":>10}{"total (s)":>11}')
+            for ph, s in sorted(summary.items(), key=lambda kv: -kv[1]['total']):
+                session.log.info(f'{ph:<20}{s["p50"]*1e3:>10.1f}{s["p95"]*1e3:>10.1f}{s["total"]:>11.2f}')
+            try:
+                dev, key = cache_key.split('/', 1)
+                session.cache.put(dev, key, summary)
+            except Exception:
+                session.log.debug('Could not put the phase timing into the cache', exc=1)
+        self.points = []
+        return summary
+
+PHASE_TIMING = TimingStats()
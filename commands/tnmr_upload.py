@@ -0,0 +1,87 @@
+# *****************************************************************************
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Davis V. Garrad <davis.last@psi.ch>
+#
+# *****************************************************************************
+
+# Avoids sending the spectrometer what it already has.
+
+import hashlib
+import json
+import threading
+
+def content_hash(obj):
+    '''A hash of the contents of a JSON-like object (pulse sequence, parameter dictionary...), independent of dictionary order.'''
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+class UploadCache:
+    '''Remembers, per TNMR device, the content hash of the last uploaded pulse sequence, and counts the round trips that were saved.
+    A sequence is only skipped if both its hash matches the last upload and the device still reports the sequence it reported right after that upload
+    (so a sequence changed by somebody else, or lost in a restart of the TNMR PC, is sent again).
+    Parameters are compared against the current (cached) parameter values of the device, and only the ones that differ are written.'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sequences = {} # device name -> (hash of the uploaded sequence, hash of what the device reported afterwards)
+        self.stats = { 'sequence_uploads': 0, 'sequence_skips': 0, 'param_writes': 0, 'param_skips': 0 }
+
+    def upload_sequence(self, tnmr, seq):
+        '''Sets tnmr.sequence_data = seq, unless the device has it already. Returns True if it was uploaded.'''
+        h = content_hash(seq)
+        with self._lock:
+            last = self.sequences.get(tnmr.name, None)
+        if not(last is None) and (last[0] == h) and (content_hash(tnmr.sequence_data) == last[1]):
+            with self._lock:
+                self.stats['sequence_skips'] += 1
+            return False
+        try:
+            tnmr.sequence_data = seq
+        except Exception:
+            self.invalidate(tnmr)
+            raise
+        with self._lock:
+            self.sequences[tnmr.name] = (h, content_hash(tnmr.sequence_data))
+            self.stats['sequence_uploads'] += 1
+        return True
+
+    def set_params(self, tnmr, dic):
+        '''Writes the parameters in dic that differ from the device's current values. Returns the names of the ones written.'''
+        written = []
+        for k, v in dic.items():
+            try:
+                unchanged = (getattr(tnmr, k) == v)
+            except Exception:
+                unchanged = False
+            if(unchanged):
+                with self._lock:
+                    self.stats['param_skips'] += 1
+                continue
+            setattr(tnmr, k, v)
+            written += [ k ]
+            with self._lock:
+                self.stats['param_writes'] += 1
+        return written
+
+    def invalidate(self, tnmr=None):
+        '''Forgets what was uploaded (to one device, or to all of them), so the next upload is sent in any case.'''
+        with self._lock:
+            if(tnmr is None):
+                self.sequences = {}
+            else:
+                self.sequences.pop(tnmr.name, None)
+
+UPLOAD_CACHE = UploadCache()
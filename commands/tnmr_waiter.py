@@ -0,0 +1,112 @@
+# *****************************************************************************
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Davis V. Garrad <davis.last@psi.ch>
+#
+# *****************************************************************************
+
+# Waiting for an acquisition to finish, without sleeping a full poll interval when it is not necessary.
+
+import threading
+import time
+
+from nicos import session
+from nicos.core import status
+
+class AcquisitionWaiter:
+    '''Schedules the polls of one point from the predicted remaining time, and wakes up early when the SEC node publishes a new status or acquisition count.
+    Polls are spaced at half the predicted remaining time (between min_interval and the device's pollinterval); once the prediction is overdue, at half
+    the time it is overdue by, so that they back off towards pollinterval again. If the cache does not deliver updates for the device, this simply
+    degrades to timed polling.
+    Use as a context manager, so the cache callbacks are removed again.'''
+    EVENT_KEYS = ('status', 'num_acqs_actual', 'value')
+
+    def __init__(self, tnmr, expected_duration, min_interval=0.05):
+        self.tnmr = tnmr
+        self.expected_duration = expected_duration
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, tnmr.pollinterval)
+        self.start = time.monotonic()
+        self.finished_at = None # time.time() at which the acquisition was seen to have finished
+        self.event = threading.Event()
+        self.num_events = 0
+        self._status_time = None # timestamp of the last idle status update from the cache
+        self._subscribed = []
+
+    def __enter__(self):
+        try:
+            for key in self.EVENT_KEYS:
+                session.cache.addCallback(self.tnmr, key, self._on_update)
+                self._subscribed += [ key ]
+        except Exception:
+            pass # no (suitable) cache. Timed polling only.
+        return self
+
+    def __exit__(self, *exc):
+        for key in self._subscribed:
+            try:
+                session.cache.removeCallback(self.tnmr, key, self._on_update)
+            except Exception:
+                pass
+        self._subscribed = []
+        return False
+
+    def _on_update(self, key, value, timestamp):
+        self.num_events += 1
+        if(key.endswith('status')):
+            try:
+                idle = (value[0] <= status.OK)
+            except Exception:
+                idle = False
+            if(idle):
+                self._status_time = timestamp # only the update saying the acquisition has finished (not e.g. the BUSY one when it started)
+        self.event.set()
+
+    def next_interval(self):
+        remaining = self.expected_duration - (time.monotonic() - self.start)
+        return min(self.max_interval, max(self.min_interval, abs(remaining)/2)) # overdue: back off, the cache wakes us up when it finishes
+
+    def wait(self, interval=None):
+        '''Waits until the next scheduled poll, or until an update arrives from the device.'''
+        if(interval is None):
+            interval = self.next_interval()
+        if(self._subscribed):
+            self.event.wait(interval)
+            self.event.clear()
+        else:
+            session.delay(interval)
+
+    def acquisition_finished(self):
+        if(self.finished_at is None):
+            # if the status change came in through the cache, its timestamp is when the acquisition really finished
+            self.finished_at = time.time() if (self._status_time is None) else min(time.time(), self._status_time)
+
+    def wait_for_counts(self, timeout=30):
+        '''After the status reports the acquisition as done, waits (up to timeout) until num_acqs_actual has caught up with num_acqs. Returns the last data read.'''
+        self.acquisition_finished()
+        st = time.monotonic()
+        data = self.tnmr.read()
+        while (time.monotonic() - st < timeout) and (self.tnmr.num_acqs_actual != self.tnmr.num_acqs):
+            self.wait(self.min_interval*2)
+            data = self.tnmr.read() # get up to date values
+        return data
+
+    def idle_time(self):
+        '''Seconds since the acquisition was seen to have finished (0 if it has not).'''
+        if(self.finished_at is None):
+            return 0.0
+        return time.time() - self.finished_at
@@ -0,0 +1,138 @@
+# *****************************************************************************
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Davis V. Garrad <davis.last@psi.ch>
+#
+# *****************************************************************************
+
+# A stand-in for the TNMR SEC node module (nmr_daq_scout), so that scans can be run and profiled without the TNMR PC.
+
+import time
+
+import numpy as np
+
+from nicos.core import Readable, Param, Override, status, usermethod, floatrange, intrange, listof, oneof, anytype
+
+from nicos_sinq.tnmr.commands.tnmr_eta import sequence_durations
+
+class SimulatedTNMR(Readable):
+    '''Imitates the TNMR module as it appears through SECoP: pulse sequence upload (sequence_data), compile_and_run, a status which is busy while
+    acquiring, num_acqs_actual counting up, and read() giving the summed FID (reals, imags, t) so far.
+    An acquisition takes as long as the pulse sequence and acquisition parameters say (see sequence_durations), times time_scale. Every call to the
+    device (read, status, upload, start) takes latency seconds, like a round trip to the TNMR PC. Its points are timed by a timing model of its own
+    (see get_timing_model), which is not saved.
+    The FID is a decaying, off-resonance signal with noise, whose amplitude follows an inversion recovery (T1) or a Hahn echo decay (T2) in the delay
+    time of the first pulse.'''
+    parameters = {
+        'sequence_data': Param('Pulse sequence (list of pulse dictionaries)', type=listof(dict), default=[], settable=True),
+        'acquisition_time': Param('Acquisition time', type=floatrange(0), default=204.8, settable=True, unit='us'),
+        'ringdown_time': Param('Ringdown time', type=floatrange(0), default=15.0, settable=True, unit='us'),
+        'pre_acquisition_time': Param('Time before every acquisition', type=floatrange(0), default=1.0, settable=True, unit='us'),
+        'post_acquisition_time': Param('Time after every acquisition', type=floatrange(0), default=250.0, settable=True, unit='ms'),
+        'acq_phase_cycle': Param('Receiver phase cycle', type=str, default='0', settable=True),
+        'obs_freq': Param('Receiver frequency', type=float, default=41.59, settable=True, unit='MHz'),
+        'num_acqs': Param('Number of acquisitions to sum', type=intrange(1, 1 << 30), default=16, settable=True),
+        'num_acqs_actual': Param('Number of acquisitions summed so far', type=int, default=0, volatile=True),
+        'nucleus': Param('Nucleus', type=str, default='', settable=True),
+        'sample': Param('Sample', type=str, default='', settable=True),
+        'comments': Param('Comments', type=str, default='', settable=True),
+        # simulation
+        'time_scale': Param('Real seconds per second of simulated acquisition', type=floatrange(0), default=1.0, settable=True),
+        'latency': Param('Duration of every call to the device (round trip to the TNMR PC)', type=floatrange(0), default=0.01, settable=True, unit='s'),
+        'upload_time': Param('Additional duration of a sequence upload', type=floatrange(0), default=0.05, settable=True, unit='s'),
+        'num_points': Param('Number of points per FID', type=intrange(1, 1 << 24), default=1024, settable=True),
+        'signal_model': Param('Dependence of the amplitude on the delay time of the first pulse. "auto": inversion recovery for three or more pulses, '
+                              'Hahn echo for two, constant otherwise', type=oneof('auto', 'inversion_recovery', 'hahn_echo', 'constant'), default='auto', settable=True),
+        't1': Param('Simulated T1', type=floatrange(0), default=3000.0, settable=True, unit='us'),
+        't2': Param('Simulated T2', type=floatrange(0), default=500.0, settable=True, unit='us'),
+        't2_star': Param('Simulated decay of the FID', type=floatrange(0), default=20.0, settable=True, unit='us'),
+        'offset': Param('Simulated offset of the resonance from obs_freq', type=float, default=0.02, settable=True, unit='MHz'),
+        'noise': Param('Noise of a single acquisition, relative to the full signal', type=floatrange(0), default=0.05, settable=True),
+        'acquired_time': Param('Total real time spent acquiring (for benchmarks)', type=float, default=0.0, internal=True),
+    }
+
+    parameter_overrides = {
+        'unit': Override(mandatory=False, default=''),
+    }
+
+    valuetype = anytype
+
+    def doInit(self, mode):
+        self._started = None
+        self._duration = 0.0
+        self._rng = np.random.default_rng()
+
+    def _roundtrip(self):
+        if(self.latency > 0):
+            time.sleep(self.latency)
+
+    def doWriteSequence_Data(self, value):
+        self._roundtrip()
+        if(self.upload_time > 0):
+            time.sleep(self.upload_time)
+
+    def _fraction(self):
+        '''Fraction of the current acquisition that is done.'''
+        if(self._started is None):
+            return 0.0
+        if(self._duration <= 0):
+            return 1.0
+        return min(1.0, (time.monotonic() - self._started)/self._duration)
+
+    @usermethod
+    def compile_and_run(self, wait=False):
+        '''Starts acquiring with the current sequence and parameters.'''
+        self._roundtrip()
+        params = { 'acquisition_time': self.acquisition_time, 'pre_acquisition_time': self.pre_acquisition_time,
+                   'post_acquisition_time': self.post_acquisition_time, 'num_acqs': self.num_acqs }
+        self._duration = float(sequence_durations(params, [ self.sequence_data ])[0])*self.time_scale
+        self._started = time.monotonic()
+        self._setROParam('acquired_time', self.acquired_time + self._duration)
+        if(wait):
+            time.sleep(self._duration)
+
+    def doReadNum_Acqs_Actual(self):
+        return int(self._fraction()*self.num_acqs)
+
+    def doStatus(self, maxage=0):
+        self._roundtrip()
+        if(self._fraction() < 1.0):
+            return status.BUSY, 'acquiring'
+        return status.OK, 'idle'
+
+    def _amplitude(self):
+        seq = self.sequence_data
+        model = self.signal_model
+        if(model == 'auto'):
+            model = 'inversion_recovery' if len(seq) >= 3 else ('hahn_echo' if len(seq) == 2 else 'constant')
+        tau = seq[0]['delay_time'] if seq else 0.0
+        if(model == 'inversion_recovery'):
+            return 1.0 - 2.0*np.exp(-tau/self.t1)
+        if(model == 'hahn_echo'):
+            return np.exp(-2.0*tau/self.t2)
+        return 1.0
+
+    def doRead(self, maxage=0):
+        self._roundtrip()
+        n = self.num_points
+        t = np.arange(n)*(self.acquisition_time/n) # us
+        acqs = int(self._fraction()*self.num_acqs)
+        fid = acqs*self._amplitude()*np.exp(-t/max(self.t2_star, 1e-12))*np.exp(2j*np.pi*self.offset*t)
+        if(acqs > 0) and (self.noise > 0):
+            scale = self.noise*np.sqrt(acqs)
+            fid = fid + self._rng.normal(scale=scale, size=n) + 1j*self._rng.normal(scale=scale, size=n)
+        return { 'reals': fid.real.tolist(), 'imags': fid.imag.tolist(), 't': t.tolist() }
@@ -56,3 +56,7 @@ update_device_parameters(nmr_daq_scout, globalparams)
 
 # Acquire data
 scan_sequences(nmr_daq_scout, seq_list) # gather the data
+
+# Alternatively, let the scan choose the delay times itself, fitting T1 after every point and stopping once it is known to 5%.
+# The intensity of a point is the phased spectrum integrated over +-50 kHz around the receiver frequency (tnmr_times in us, so frequencies in MHz)
+#adaptive_relaxation_scan(nmr_daq_scout, seq, [0], 10, 1_000_000, model='T1', precision=0.05, integration=(-0.05, 0.05))
@@ -41,10 +41,11 @@ fields = [ 6.8 + i*1e-3 for i in range(2000) ]
 
 print(timestring(estimate_scan_length(globalparams, seq)*len(fields)))
 
-with tnmr_scan(): # Enters a mode of manual file control. Values will now be written into a single file until the context is lost
-    for field in fields:
-        maw(se_mf, field) # assuming se_mf controls the reader's external field strength (PPMS, etc.)
-        print_sequence(seq)
-    
-        # Acquire data
-        scan_sequence(nmr_daq_scout, seq) # gather the data
+# Equivalent to
+#   with tnmr_scan():
+#       for field in fields:
+#           maw(se_mf, field)
+#           scan_sequence(nmr_daq_scout, seq)
+# but the magnet already ramps to the next field while a point is being written out.
+# The field counts as settled once it has stayed within 1e-4 of the setpoint for 2 s (assuming se_mf controls the external field, PPMS, etc.)
+sweep_setpoints(nmr_daq_scout, seq, se_mf, fields, tolerance=1e-4, settle_time=2, timeout=600)
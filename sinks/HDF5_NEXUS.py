@@ -1,13 +1,23 @@
 from nicos.devices.datasinks import FileSink
 from nicos.core.data.sink import DataSinkHandler
-from nicos.core import Override, Param
+from nicos.core import Override, Param, floatrange, intrange, dictof, listof, oneof
 from nicos.core.constants import POINT, SCAN, SUBSCAN
 from nicos import session
+from nicos.utils import createThread
 
 import h5py as hdf
 import numpy as np
+from nicos_sinq.tnmr.sinks.storage_policy import match_policy, check_policy, apply_dtype, dataset_options
+from nicos_sinq.tnmr.commands.tnmr_timing import TimingStats
+import os
 import time
 import datetime # For simple ISO8601 usage.
+import hashlib
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+RESUME_FILES = [] # existing scan files which the next scan is written into instead of new ones (set by tnmr_scan while it begins the scan)
 
 # A couple specific NeXus functionalities
 def initialise_nexus_entry(file, index, timestamp):
@@ -34,8 +44,51 @@ def initialise_nexus_entry(file, index, timestamp):
     return entry_group
 
             
-def choose_entry_from_datetime(file, datetime_iso):
-    '''file should be an HDF file object, which should be _open_. Returns the dataset, and a bool indicating if this is a newly created dataset.'''
+def read_entry_start_time(entry_group):
+    '''Returns the start time (ISO8061 string) of an entry group, without the padding of the fixed-length string.'''
+    return np.array(entry_group['start_time'], 'S').tobytes().decode('utf-8').rstrip('\x00')
+
+class EntryIndex:
+    '''In-memory map from entry start time (ISO8061 string) to entry group name for one file, plus the next free entry index.
+    Built once from the file (walking all entries), after which finding the entry for a value is a single dictionary lookup.
+    An entry without a start time is a spare, created ahead of time (see the swmr parameter of the sink), which is taken by the next new entry.'''
+    def __init__(self, file):
+        self.by_time = {}
+        self.next_index = 1
+        self.spare = None # name of the spare entry, if there is one
+        self.precreated = set() # names of the entries which were taken from a spare
+        for name in file.keys():
+            if 'entry' in name:
+                start = read_entry_start_time(file[name])
+                if(start == ''):
+                    self.spare = name
+                else:
+                    self.by_time[start] = name
+                self.next_index = max(self.next_index, int(name[5:]) + 1)
+
+    def choose(self, file, datetime_iso):
+        '''Same contract as choose_entry_from_datetime.'''
+        name = self.by_time.get(datetime_iso, None)
+        if not(name is None):
+            return file[name], False
+        if not(self.spare is None):
+            entry_group = file[self.spare]
+            entry_group['start_time'][0] = datetime_iso
+            self.by_time[datetime_iso] = self.spare
+            self.precreated.add(self.spare)
+            self.spare = None
+            return entry_group, True
+        entry_group = initialise_nexus_entry(file, self.next_index, datetime_iso)
+        self.by_time[datetime_iso] = entry_group.name.lstrip('/')
+        self.next_index += 1
+        return entry_group, True
+
+def choose_entry_from_datetime(file, datetime_iso, index=None):
+    '''file should be an HDF file object, which should be _open_. Returns the dataset, and a bool indicating if this is a newly created dataset.
+    If an EntryIndex for this file is given, it is used instead of walking through all entries in the file.'''
+    if not(index is None):
+        return index.choose(file, datetime_iso)
+    
     entries = list(file.keys())
     datetimes = []
     tmp = []
@@ -63,6 +116,162 @@ def choose_entry_from_datetime(file, datetime_iso):
     
     return entry_group, True
 
+def combine_complex(vals, dtype='complex64'):
+    '''Merges pairs of real and imaginary parts in a putValues dictionary into single complex arrays.
+    A key whose name (after the tags) ends in '_reals' is paired with the key ending in '_imags' with the same prefix and timestamp; both are replaced by '<prefix>_fid', which keeps the tags of the real part (so 'signal:tnmr_reals' and 'auxiliary_signals:tnmr_imags' become 'signal:tnmr_fid').
+    The complex array is allocated once, and the parts are copied into it through its real/imag views.'''
+    imag_keys = {}
+    for key in vals:
+        name = key.split(':')[-1]
+        if(name.endswith('_imags')):
+            imag_keys[name[:-len('_imags')]] = key
+    ret = dict(vals)
+    for key, (timestamp, reals) in vals.items():
+        tags, _, name = key.rpartition(':')
+        if not(name.endswith('_reals')):
+            continue
+        prefix = name[:-len('_reals')]
+        ikey = imag_keys.get(prefix, None)
+        if(ikey is None) or (vals[ikey][0] != timestamp):
+            continue
+        reals = np.asarray(reals)
+        imags = np.asarray(vals[ikey][1])
+        n = min(len(reals), len(imags))
+        fid = np.empty((n,) + reals.shape[1:], dtype=dtype)
+        fid.real[...] = reals[:n]
+        fid.imag[...] = imags[:n]
+        del ret[key]
+        del ret[ikey]
+        ret[(tags + ':' if tags else '') + prefix + '_fid'] = (timestamp, fid)
+    return ret
+
+def prepare_value(v, settings):
+    '''Converts lists (also inside dictionaries) to arrays, down-cast according to the storage settings, so this happens once per value and not once per file.'''
+    if(isinstance(v, dict)):
+        return { k: prepare_value(val, settings) for k, val in v.items() }
+    if(isinstance(v, list) or isinstance(v, np.ndarray)):
+        varr = np.asarray(v)
+        if(varr.dtype.kind in 'biufc'):
+            return apply_dtype(settings, varr)
+        return varr
+    return v
+
+class UniformAxis:
+    '''An evenly spaced axis (start + step*i), which is stored once per file in /shared_axes and hard-linked from every entry that uses it (shared_axes).'''
+    __slots__ = ('values', 'start', 'step')
+
+    def __init__(self, values, start, step):
+        self.values = values
+        self.start = start
+        self.step = step
+
+    def shared_name(self, name):
+        h = hashlib.sha1(repr((self.start, self.step, len(self.values), self.values.dtype.str)).encode('utf-8')).hexdigest()[:16]
+        return f'{name}_{h}'
+
+def as_uniform_axis(varr, rtol=1e-9):
+    '''Returns a UniformAxis if the 1-D numeric array varr is evenly spaced (checked in one vectorised comparison), otherwise None.'''
+    if(varr.ndim != 1) or (len(varr) < 2) or not(varr.dtype.kind in 'iuf'):
+        return None
+    start = varr[0]
+    step = varr[1] - varr[0]
+    expected = start + step*np.arange(len(varr))
+    if not(np.allclose(varr, expected, rtol=rtol, atol=abs(step)*rtol)):
+        return None
+    return UniformAxis(varr, start.item(), step.item())
+
+def content_digest(v, h=None):
+    '''Hash of a (prepared) value, dictionaries included, for finding identical groups (shared_groups).'''
+    top = h is None
+    if(top):
+        h = hashlib.sha1()
+    if(isinstance(v, dict)):
+        h.update(b'{')
+        for k in sorted(v.keys(), key=str):
+            h.update(repr(k).encode('utf-8') + b':')
+            content_digest(v[k], h)
+        h.update(b'}')
+    elif(isinstance(v, np.ndarray)):
+        h.update(f'{v.dtype.str}{v.shape}'.encode('utf-8'))
+        h.update(np.ascontiguousarray(v).tobytes() if v.dtype.kind != 'O' else repr(v.tolist()).encode('utf-8'))
+    else:
+        h.update(f'{type(v).__name__}:{v!r};'.encode('utf-8'))
+    if(top):
+        return h.hexdigest()[:20]
+
+class SharedGroup:
+    '''A dictionary which is stored once per file in /sequences/<digest> and hard-linked from every entry that uses it (shared_groups).'''
+    __slots__ = ('values', 'digest')
+
+    def __init__(self, values, digest):
+        self.values = values
+        self.digest = digest
+
+def storagepolicy(val=None):
+    '''Parameter type for the storage_policy parameter.'''
+    if(val is None):
+        return {}
+    return check_policy(dictof(str, dict)(val))
+
+def lookup3(data):
+    '''Bob Jenkins' lookup3 hash (hashlittle, initial value 0), which HDF5 uses for the checksums of its metadata.'''
+    M = 0xffffffff
+    rot = lambda x, k: ((x << k) | (x >> (32 - k))) & M
+    n = len(data)
+    a = b = c = (0xdeadbeef + n) & M
+    i = 0
+    while n > 12:
+        a = (a + int.from_bytes(data[i:i+4], 'little')) & M
+        b = (b + int.from_bytes(data[i+4:i+8], 'little')) & M
+        c = (c + int.from_bytes(data[i+8:i+12], 'little')) & M
+        a = (a - c) & M; a ^= rot(c, 4);  c = (c + b) & M
+        b = (b - a) & M; b ^= rot(a, 6);  a = (a + c) & M
+        c = (c - b) & M; c ^= rot(b, 8);  b = (b + a) & M
+        a = (a - c) & M; a ^= rot(c, 16); c = (c + b) & M
+        b = (b - a) & M; b ^= rot(a, 19); a = (a + c) & M
+        c = (c - b) & M; c ^= rot(b, 4);  b = (b + a) & M
+        n -= 12
+        i += 12
+    if(n == 0):
+        return c
+    tail = data[i:i+n] + bytes(12 - n)
+    a = (a + int.from_bytes(tail[0:4], 'little')) & M
+    b = (b + int.from_bytes(tail[4:8], 'little')) & M
+    c = (c + int.from_bytes(tail[8:12], 'little')) & M
+    c ^= b; c = (c - rot(b, 14)) & M
+    a ^= c; a = (a - rot(c, 11)) & M
+    b ^= a; b = (b - rot(a, 25)) & M
+    c ^= b; c = (c - rot(b, 16)) & M
+    a ^= c; a = (a - rot(c, 4)) & M
+    b ^= a; b = (b - rot(a, 14)) & M
+    c ^= b; c = (c - rot(b, 24)) & M
+    return c
+
+def clear_write_flags(path):
+    '''Clears the flags which mark a file (of the newest format, as written with swmr) as open for writing, which are left set if the writer did not
+    close it, e.g. because NICOS was killed. This is what "h5clear -s" does; the file must not be open anywhere. Returns True if flags were cleared.'''
+    with open(path, 'r+b') as f:
+        for offset in (0, 512, 1024, 2048, 4096, 8192):
+            f.seek(offset)
+            head = f.read(12)
+            if(head[:8] == b'\x89HDF\r\n\x1a\n'):
+                break
+        else:
+            return False
+        version, size_offsets, flags = head[8], head[9], head[11]
+        if(version < 2) or (flags == 0):
+            return False # older superblocks have no such flags
+        n = 12 + 4*size_offsets
+        f.seek(offset)
+        block = bytearray(f.read(n + 4))
+        if(lookup3(bytes(block[:n])) != int.from_bytes(block[n:], 'little')):
+            return False # not what it looks like; leave it alone
+        block[11] = 0
+        block[n:] = lookup3(bytes(block[:n])).to_bytes(4, 'little')
+        f.seek(offset)
+        f.write(block)
+    return True
+
 # The actual workhorse
 class HDF5ScanfileSinkHandler(DataSinkHandler):
     def __init__(self, sink, dataset, detector):
@@ -70,23 +279,296 @@ class HDF5ScanfileSinkHandler(DataSinkHandler):
         self._file = []
         self._fname = None
         self._template = sink.filenametemplate
+        self._handles = {} # filepath -> open HDF file object. Only used if the sink has keep_open set.
+        self._entry_indices = {} # filepath -> EntryIndex, built the first time the file is written to
+        self._last_written = {} # (filename, dataset name) -> the array last written there during the current point, for partial updates
+        self._shared_links = {} # (filename, link path) -> path of the shared group or axis it links to (shared_groups, shared_axes)
+        self._shared_refs = {} # (filename, shared path) -> number of links to it. Only objects created by this handler are counted (and removed).
+        self._deferred_links = {} # (filename, parent group path, key) -> (shared value, storage settings): written in place during the point, linked in addSubset
+        self._last_flush = time.monotonic()
+        self._num_writes = 0
+        self._write_time = 0.0 # seconds spent actually writing, for judging the cost of the different modes
+        # background writer (async_write)
+        self._writer = None
+        self._pending = {} # (key, timestamp) -> (timestamp, value), in order of arrival. Later updates of the same value replace earlier ones.
+        self._cond = threading.Condition()
+        self._busy = False
+        self._stop = False
+        self._max_depth = 0
+        self._wait_time = 0.0 # seconds putValues spent blocked on a full queue
+        self._pool = None # thread pool for reading the detectors/environment, created on first use
+        self._reads = {} # device name -> future of its last snapshot read, so that a device which hangs takes up no more than one worker
+        self._mirror_pool = None # single background thread for writing all but the first file (mirror_async)
+        self._mirror_futures = []
+        # phase timing (phase_timing)
+        self._timing = False # sink.phase_timing, read once per point
+        self._phases = {} # phase -> seconds, for the current point
+        self._phase_lock = threading.Lock()
+        self._point_timestamp = None # timestamp of the values of the current point, to write its timing into the right entry
+        self._timing_stats = TimingStats()
+        # single writer/multiple readers (swmr)
+        self._swmr_failed = set()
+        self._point_entries = {} # filepath -> name of the entry written during the current point, the layout for the spare entry
+        self._initial_written = {} # (filepath, entry name) -> names written into initial_environment of an entry taken from a spare
         hdf.get_config().track_order = True # keeps the order that objects are added in.
 
     def prepare(self):
-        self.manager.assignCounter(self.dataset)
-        
-        self._fname, self._filepaths = self.manager.getFilenames(self.dataset, self._template, self.sink.subdir)
+        resume_files = list(RESUME_FILES) # an interrupted scan being resumed
+        if(resume_files):
+            self._filepaths = list(resume_files)
+            self._fname = os.path.basename(self._filepaths[0])
+        else:
+            self.manager.assignCounter(self.dataset)
+            self._fname, self._filepaths = self.manager.getFilenames(self.dataset, self._template, self.sink.subdir)
+        self.dataset.tnmr_files = list(self._filepaths) # so that the scan journal knows where the points went
         
         for f in self._filepaths:
-            self._file += [ hdf.File(f, 'a', userblock_size=512) ] # make sure we can open it
-            self._file[-1].close()
+            try:
+                self._file += [ hdf.File(f, 'a', userblock_size=512, **self._open_options()) ] # make sure we can open it
+            except OSError:
+                # a file being resumed, which was written with swmr, is still marked as open for writing if NICOS did not close it
+                if not(resume_files) or not(clear_write_flags(f)):
+                    raise
+                session.log.warning(f'{f} was not closed properly, cleared its "open for writing" flags to resume into it')
+                self._file += [ hdf.File(f, 'a', userblock_size=512, **self._open_options()) ]
+            if(self.sink.keep_open) or (self.sink.swmr):
+                self._handles[f] = self._file[-1]
+            else:
+                self._file[-1].close()
+        
+        if(self.sink.async_write):
+            self._writer = createThread('HDF5 NeXus writer', self._writer_loop)
+
+    def _writer_loop(self):
+        while True:
+            with self._cond:
+                while not(self._pending) and not(self._stop):
+                    self._cond.wait()
+                if not(self._pending):
+                    return # stopped, and nothing left to write
+                batch = self._pending
+                self._pending = {}
+                self._busy = True
+                self._cond.notify_all() # there is space in the queue again
+            try:
+                # values with the same timestamp (i.e., for the same entry) are written together
+                by_time = {}
+                for (key, timestamp), val in batch.items():
+                    by_time.setdefault(timestamp, {})[key] = val
+                for vals in by_time.values():
+                    self._write_values(vals, snapshot=False) # taken in putValues
+            except Exception:
+                session.log.warning('HDF_NeXus: background write failed', exc=1)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _drain(self):
+        '''Blocks until the background writer (if any) and the mirror writes have written everything that was queued.'''
+        if not(self._writer is None):
+            with self._cond:
+                while self._pending or self._busy:
+                    self._cond.wait()
+        self._drain_mirrors()
+
+    def _stop_writer(self):
+        if(self._writer is None):
+            return
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        self._writer.join()
+        self._writer = None
+
+    def _read_device(self, key, deadline):
+        '''Reads one device for the snapshot. Returns (value, age in seconds). The value is taken from the cache if it is younger than snapshot_maxage, otherwise the device is read, retrying with an exponential backoff until deadline (time.monotonic()).
+        If the device cannot be read, (0, nan) is returned.'''
+        dev = session.getDevice(key)
+        if(self.sink.snapshot_maxage > 0):
+            try:
+                ts, _ttl, v = session.cache.get_explicit(dev, 'value', None)
+                if not(ts is None) and (time.time() - ts <= self.sink.snapshot_maxage):
+                    return v, time.time() - ts
+            except Exception:
+                pass # no cache, or no value in it. Just read it.
+        retries = 0
+        backoff = 0.05
+        while True:
+            try:
+                return dev.read(0), 0.0
+            except Exception:
+                retries += 1
+                if(retries > self.sink.snapshot_retries) or (time.monotonic() + backoff > deadline):
+                    break
+                session.log.info(f'Trying to read {key} again')
+                time.sleep(backoff)
+                backoff *= 2
+        session.log.info(f'Failed to read {key}. Setting zero.')
+        return 0, float('nan')
+
+    def _snapshot_devices(self):
+        '''Reads all detectors and environment devices concurrently. Returns a dictionary of device name -> (value, age in seconds).
+        Every read is bounded by snapshot_timeout, and the whole snapshot by snapshot_total_timeout; devices which do not answer in time are recorded as 0 (with an age of nan).
+        A read which timed out cannot be cancelled, so a device is not read again until its last read has returned.'''
+        keys = list(session.experiment.detlist) + list(session.experiment.envlist)
+        if(len(keys) == 0):
+            return {}
+        if(self._pool is None):
+            # at least one worker per device, so a device which hangs does not hold up the others
+            self._pool = ThreadPoolExecutor(max_workers=max(8, len(keys)), thread_name_prefix='HDF5 NeXus snapshot')
+        start = time.monotonic()
+        deadline = start + min(self.sink.snapshot_timeout, self.sink.snapshot_total_timeout)
+        total_deadline = start + self.sink.snapshot_total_timeout
+        futures = {}
+        for key in keys:
+            previous = self._reads.get(key, None)
+            if not(previous is None) and not(previous.done()):
+                continue # still hanging in an earlier read
+            futures[key] = self._reads[key] = self._pool.submit(self._read_device, key, deadline)
+        snapshot = {}
+        for key in keys:
+            fut = futures.get(key, None)
+            if(fut is None):
+                session.log.warning(f'{key} has not answered an earlier read yet. Setting zero.')
+                snapshot[key] = (0, float('nan'))
+                continue
+            try:
+                snapshot[key] = fut.result(timeout=max(0.0, min(deadline, total_deadline) - time.monotonic()))
+            except FutureTimeoutError:
+                session.log.warning(f'Timed out reading {key}. Setting zero.')
+                snapshot[key] = (0, float('nan'))
+            except Exception:
+                session.log.warning(f'Failed to read {key}. Setting zero.', exc=1)
+                snapshot[key] = (0, float('nan'))
+        return snapshot
+
+    def _phase(self, name, t0):
+        '''Adds the time since t0 (time.monotonic()) to the phase of the current point, if phase timing is on.'''
+        if(self._timing):
+            dt = time.monotonic() - t0
+            with self._phase_lock:
+                self._phases[name] = self._phases.get(name, 0.0) + dt
+
+    def _report_io(self):
+        '''Publishes the writer statistics on the sink, to tell I/O costs apart from acquisition costs.'''
+        if(self._num_writes == 0):
+            return
+        latency = self._write_time / self._num_writes
+        try:
+            self.sink._setROParam('write_latency', latency)
+            self.sink._setROParam('queue_depth', self._max_depth)
+        except Exception:
+            pass
+        session.log.debug(f'HDF_NeXus: {self._num_writes} writes, {latency*1e3:.1f} ms per write on average, '
+                          f'max. queue depth {self._max_depth}, {self._wait_time:.2f} s blocked on a full queue '
+                          f'(keep_open={self.sink.keep_open}, async_write={self.sink.async_write})')
+
+    @contextmanager
+    def _open_file(self, f):
+        '''Yields an _open_ HDF file object for the path f. If the sink has keep_open set, the handle from prepare is reused (and only closed in end), otherwise the file is opened and closed around every use.'''
+        if(self.sink.keep_open) or (self.sink.swmr):
+            if not(f in self._handles):
+                self._handles[f] = hdf.File(f, 'a', **self._open_options())
+            yield self._handles[f]
+        else:
+            with hdf.File(f, 'a') as file:
+                yield file
+
+    def _flush(self, force=False):
+        '''Flushes all held handles, either when forced (point boundaries) or when flush_interval has elapsed since the last flush. Does nothing if the files are not held open.'''
+        if not(self.sink.keep_open) and not(self.sink.swmr):
+            return
+        now = time.monotonic()
+        if(force or (now - self._last_flush >= self.sink.flush_interval)):
+            for file in self._handles.values():
+                file.flush()
+            self._last_flush = now
+
+    def _open_options(self):
+        '''SWMR needs the newest file format, and no locking, so that readers following the file do not keep it from being reopened.'''
+        return { 'libver': 'latest', 'locking': False } if self.sink.swmr else {}
+
+    def _swmr_apply(self, apply, f, in_place=None):
+        '''Calls apply(f) with f in SWMR mode if in_place(file) says the write only goes to existing datasets, and out of it otherwise.'''
+        with self._open_file(f) as file:
+            pass
+        file = self._handles[f]
+        if(file.swmr_mode) and not(in_place is None) and in_place(file):
+            try:
+                apply(f)
+                return
+            except Exception:
+                session.log.debug('HDF_NeXus: write not possible in SWMR mode, reopening the file', exc=1)
+        if(file.swmr_mode):
+            self._bump_generation(file, changing=True) # before the file changes under the readers
+            file.flush()
+            file.close()
+            self._handles[f] = hdf.File(f, 'a', **self._open_options())
+        apply(f)
+        self._start_swmr(f)
+
+    def _bump_generation(self, file, changing=False):
+        '''Odd while the structure of the file is changing, even otherwise. Readers cannot see new objects without reopening the file, this tells them to.'''
+        if('metadata/swmr_generation' in file):
+            ds = file['metadata/swmr_generation']
+            ds[0] = (int(ds[0]) | 1) + (0 if changing else 1)
+
+    def _in_place(self, file, f, ops):
+        '''True if writing ops only writes to datasets which exist already (in the entries of their points, or in the spare entry).'''
+        if not(f in self._entry_indices):
+            self._entry_indices[f] = EntryIndex(file)
+        index = self._entry_indices[f]
+        spare = index.spare
+        new = {}
+        for (start_dt_iso, name, target_groups, formatted_key, value, settings) in ops:
+            entry = index.by_time.get(start_dt_iso, None) or new.get(start_dt_iso, None)
+            if(entry is None):
+                if(spare is None):
+                    return False
+                entry = new[start_dt_iso] = spare
+                spare = None
+            for group_key in target_groups:
+                if not(self._layout_exists(file, f'{entry}/{group_key}/{name}', value)):
+                    return False
+        return True
+
+    def _layout_exists(self, file, path, value):
+        if(isinstance(value, (SharedGroup, UniformAxis))):
+            value = value.values
+        if not(path in file):
+            return False
+        if(isinstance(value, dict)):
+            return all(self._layout_exists(file, f'{path}/{k}', v) for k, v in value.items())
+        return True
+
+    def _start_swmr(self, f):
+        file = self._handles[f]
+        self._bump_generation(file) # the structure is settled
+        try:
+            file.swmr_mode = True
+        except Exception:
+            if not(f in self._swmr_failed):
+                self._swmr_failed.add(f) # e.g., a file from before that does not have the newest format. Written normally
+                session.log.warning(f'Could not switch {f} to SWMR mode, live readers will not be able to follow it', exc=1)
+
+    def _close_files(self):
+        for file in self._handles.values():
+            try:
+                file.close()
+            except Exception:
+                session.log.warning('Could not close HDF file', exc=1)
+        self._handles = {}
 
     def begin(self):
+        self._timing = self.sink.phase_timing
         for f in self._filepaths:
-            with hdf.File(f, 'a') as file:
+            with self._open_file(f) as file:
                 file.attrs['version'] = '100' # reserved for non-backwards-compatible changes!
                 # Side note on the file version: 100 is the first one. I am quite proud of my backwards compatibility so far! -DG
                 g = file.require_group('/metadata/')
+                if(self.sink.swmr) and not('swmr_generation' in g):
+                    g.create_dataset('swmr_generation', data=[ 0 ], dtype='i8') # counts changes of the structure, see _bump_generation
                 try:
                     d = g.create_dataset('date', data=f'{time.time()} ({time.gmtime()})', dtype=hdf.string_dtype(length=128))
                     lc = g.create_dataset('local_contact', data=f'{session.experiment.localcontact}', dtype=hdf.string_dtype(length=128))
@@ -94,21 +576,31 @@ class HDF5ScanfileSinkHandler(DataSinkHandler):
                     u = g.create_dataset('users', data=f'{session.experiment.users}', dtype=hdf.string_dtype(length=128))
                 except:
                     pass
+            if(self.sink.swmr):
+                self._start_swmr(f) # readers can open the file from here on
     
     def putMetainfo(self, mi):
         session.log.info('mi')
         session.log.info(str(mi))
         
-    def __save_val(self, v, key, file, parent_group):
+    def __save_val(self, v, key, file, parent_group, settings={}):
+        '''settings are the storage settings (see storage_policy) which apply to v, and to everything inside it if it is a dictionary.'''
         ret = None
         if(isinstance(v, dict)):
             pg = parent_group.require_group(str(key))
-            self.__save_dict(v, file, pg)
+            self.__save_dict(v, file, pg, settings)
             ret = pg
+        elif(isinstance(v, SharedGroup)):
+            ret = self.__link_shared_group(v, str(key), file, parent_group, settings)
+        elif(isinstance(v, UniformAxis)):
+            ret = self.__link_shared_axis(v, str(key), file, parent_group)
         elif(isinstance(v, list) or isinstance(v, np.ndarray)):
-            varr = np.array(v)
-            ret = parent_group.require_dataset(str(key), data=varr, shape=varr.shape, dtype=varr.dtype, exact=False)
-            ret[:] = varr
+            varr = np.asarray(v)
+            if(varr.dtype.kind in 'biufc' and varr.ndim > 0):
+                ret = self.__save_array(apply_dtype(settings, varr), str(key), file, parent_group, settings) # no-op if prepared already
+            else:
+                ret = parent_group.require_dataset(str(key), data=varr, shape=varr.shape, dtype=varr.dtype, exact=False)
+                ret[:] = varr
         elif(isinstance(v, str)):
             ret = parent_group.require_dataset(str(key), data=v, shape=1, dtype=hdf.string_dtype(length=len(v) + 16), exact=False)
             ret[0] = v
@@ -118,11 +610,210 @@ class HDF5ScanfileSinkHandler(DataSinkHandler):
             ret[:] = varr
         return ret
     
-    def __save_dict(self, d, file, parent_group):
+    def __save_array(self, varr, key, file, parent_group, settings={}):
+        '''Numeric arrays are stored in chunked datasets which are resizable along every axis, so a FID which grows between polls is extended in place.
+        Only the runs of chunks (along the first axis) that differ from what was last written during this point are actually written.'''
+        ret = None
+        if(key in parent_group):
+            ret = parent_group[key]
+            if not(isinstance(ret, hdf.Dataset)) or (ret.chunks is None) or (ret.ndim != varr.ndim) or not(np.can_cast(varr.dtype, ret.dtype, 'same_kind')):
+                # written by an older version (contiguous), or the type changed. Start over.
+                del parent_group[key]
+                ret = None
+        if(ret is None):
+            ret = parent_group.create_dataset(key, data=varr, **dataset_options(settings, varr.shape))
+            self._last_written[(file.filename, ret.name)] = varr.copy()
+            return ret
+
+        cache_key = (file.filename, ret.name)
+        old = self._last_written.get(cache_key, None)
+        if(ret.shape != varr.shape):
+            ret.resize(varr.shape)
+            if not(old is None) and (old.shape[1:] != varr.shape[1:]):
+                old = None
+        if(old is None):
+            ret[...] = varr
+        else:
+            # find out which chunks (along the first axis) changed, and only write those
+            n = varr.shape[0]
+            n_old = min(old.shape[0], n)
+            changed = np.ones(n, dtype=bool)
+            if(n_old > 0):
+                changed[:n_old] = (old[:n_old] != varr[:n_old]).reshape(n_old, -1).any(axis=1)
+            c = ret.chunks[0]
+            chunk_changed = np.logical_or.reduceat(changed, np.arange(0, n, c)) if n > 0 else changed
+            # write contiguous runs of changed chunks in one go
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], chunk_changed.astype(np.int8), [0]))))
+            for a, b in zip(edges[::2], edges[1::2]):
+                ret[a*c:min(b*c, n)] = varr[a*c:min(b*c, n)]
+        self._last_written[cache_key] = varr.copy()
+        return ret
+
+    def __link_shared_axis(self, axis, key, file, parent_group):
+        '''Writes the axis into /shared_axes once, and hard-links it into parent_group under key (replacing whatever was there).'''
+        shared = file.require_group('/shared_axes')
+        sname = axis.shared_name(key)
+        if not(sname in shared):
+            ds = shared.create_dataset(sname, data=axis.values)
+            ds.attrs['start'] = axis.start
+            ds.attrs['step'] = axis.step
+            ds.attrs['length'] = len(axis.values)
+            self._shared_refs[(file.filename, ds.name)] = 0
+        return self.__relink(file, parent_group, key, f'/shared_axes/{sname}')
+
+    def __unlink(self, file, parent_group, key):
+        '''Removes the link parent_group/key to a shared object, and the shared object itself if this handler created it and nothing links to it any more.'''
+        previous = self._shared_links.pop((file.filename, f'{parent_group.name}/{key}'), None)
+        if(previous is None):
+            return
+        if(key in parent_group):
+            del parent_group[key]
+        if((file.filename, previous) in self._shared_refs):
+            self._shared_refs[(file.filename, previous)] -= 1
+            if(self._shared_refs[(file.filename, previous)] <= 0):
+                del self._shared_refs[(file.filename, previous)]
+                del file[previous]
+
+    def __relink(self, file, parent_group, key, path):
+        '''Hard-links the shared object at path into parent_group under key, in place of whatever was there.'''
+        link = f'{parent_group.name}/{key}'
+        if(self._shared_links.get((file.filename, link)) == path) and (key in parent_group):
+            return file[path]
+        self.__unlink(file, parent_group, key)
+        if(key in parent_group):
+            del parent_group[key] # written in place during the point
+        parent_group[key] = file[path]
+        self._shared_links[(file.filename, link)] = path
+        if((file.filename, path) in self._shared_refs):
+            self._shared_refs[(file.filename, path)] += 1
+        return file[path]
+
+    def _finish_structure(self):
+        '''At the end of a point, links the values stored once per file to their shared copy, and (with swmr) creates the spare entry of the next point.'''
+        deferred = self._deferred_links
+        self._deferred_links = {}
+        templates = self._point_entries
+        self._point_entries = {}
+        def finish(f):
+            with self._open_file(f) as file:
+                for (filename, parent, key), (value, settings) in deferred.items():
+                    if(filename != file.filename) or not(parent in file):
+                        continue
+                    if(isinstance(value, UniformAxis)):
+                        self.__link_shared_axis(value, key, file, file[parent])
+                    elif(isinstance(value, SharedGroup)):
+                        self.__link_shared_group(value, key, file, file[parent], settings)
+                if(self.sink.swmr) and (f in templates):
+                    self._create_spare(file, f, templates[f])
+        def nothing_to_do(file, f):
+            index = self._entry_indices.get(f, None)
+            return not any(k[0] == file.filename for k in deferred) and ((index is None) or not(index.spare is None) or not(f in templates))
+        apply = (lambda f: self._swmr_apply(finish, f, lambda file: nothing_to_do(file, f))) if self.sink.swmr else finish
+        if not(deferred) and not(self.sink.swmr):
+            return
+        for i, f in enumerate(self._filepaths):
+            if(i > 0) and (self.sink.mirror_async):
+                self._submit_mirror(apply, f)
+            else:
+                apply(f)
+
+    def _create_spare(self, file, f, template):
+        '''Creates the entry of the next point ahead of time (without a start time, see EntryIndex), laid out like the entry template.'''
+        index = self._entry_indices[f]
+        if not(index.spare is None) or not(template in file):
+            return
+        g = initialise_nexus_entry(file, index.next_index, '')
+        index.spare = g.name.lstrip('/')
+        index.next_index += 1
+        def copy(name, obj):
+            if(name in g):
+                return
+            if(isinstance(obj, hdf.Group)):
+                dst = g.create_group(name)
+                for k, v in obj.attrs.items():
+                    if(k != 'source'): # of a shared group
+                        dst.attrs[k] = v
+            elif(obj.dtype.kind in 'biufc') and (obj.ndim > 0) and (not(obj.chunks is None) or (obj.size != 1)):
+                # written by __save_array, which extends the dataset
+                g.create_dataset(name, shape=(0,)*obj.ndim, maxshape=(None,)*obj.ndim, dtype=obj.dtype, chunks=obj.chunks or True,
+                                 compression=obj.compression, compression_opts=obj.compression_opts, shuffle=obj.shuffle)
+            else:
+                g.create_dataset(name, shape=obj.shape, dtype=obj.dtype)
+        file[template].visititems(copy)
+
+    def _remove_spares(self):
+        '''Removes the spare entries which were not needed any more, at the end of the scan.'''
+        def remove(f):
+            with self._open_file(f) as file:
+                index = self._entry_indices.get(f, None)
+                if not(index is None) and not(index.spare is None):
+                    del file[index.spare]
+                    index.spare = None
+        for f in self._filepaths:
+            index = self._entry_indices.get(f, None)
+            if not(index is None) and not(index.spare is None):
+                self._swmr_apply(remove, f)
+
+    def __link_shared_group(self, shared, key, file, parent_group, settings={}):
+        '''Writes the dictionary into /sequences once, and hard-links it into parent_group under key. A shared group which this handler created, and
+        which is no longer linked from anywhere (e.g., parameters which were updated during the point), is removed again.'''
+        path = f'/sequences/{shared.digest}'
+        if not(path in file):
+            g = file.require_group(path)
+            g.attrs['source'] = key
+            self.__save_dict(shared.values, file, g, settings)
+            self._shared_refs[(file.filename, path)] = 0
+        return self.__relink(file, parent_group, key, path)
+
+    def __save_dict(self, d, file, parent_group, settings={}):
         for key, val in d.items():
-            self.__save_val(val, key, file, parent_group)
+            self.__save_val(val, key, file, parent_group, settings)
     
     def putValues(self, vals):
+        for val in vals.values():
+            self._point_timestamp = val[0]
+        derived = all(key.startswith('derived:') for key in vals) # computed after the acquisition: the devices may have moved on since
+        if(self._writer is None):
+            self._write_values(vals, snapshot=not(derived))
+            return
+        if not(derived):
+            vals = self._add_snapshot(vals) # now, not when the writer gets to it
+        t0 = time.monotonic()
+        with self._cond:
+            while len(self._pending) >= self.sink.queue_size:
+                self._cond.wait() # backpressure: the disk is not keeping up
+            for key, val in vals.items():
+                old = self._pending.pop((key, val[0]), None) # re-insert, so the order of arrival is kept
+                if not(old is None) and ((key in session.experiment.envlist) or ('environment/' in key)) and not(key.startswith('initial_environment/')):
+                    # the replaced value would have been the first one of the entry, so it is kept for initial_environment (see _prepare)
+                    name = key.split(':')[-1]
+                    name = name.split('/', 1)[-1]
+                    self._pending.setdefault((f'initial_environment/{name}', val[0]), old)
+                self._pending[(key, val[0])] = val
+            self._max_depth = max(self._max_depth, len(self._pending))
+            self._cond.notify_all()
+        self._wait_time += time.monotonic() - t0
+        self._phase('sink_queue_wait', t0)
+
+    def _add_snapshot(self, vals):
+        '''Returns vals plus a snapshot of the detectors and environment (and its age), and the end time of the entry, with the timestamp of vals.'''
+        t0 = time.monotonic()
+        snapshot = self._snapshot_devices()
+        self._phase('sink_snapshot', t0)
+        dummytime = 0
+        for val in vals.values():
+            dummytime = val[0]
+        if(dummytime == 0):
+            dummytime = time.time()
+        vals = dict(vals)
+        for key, (v, age) in snapshot.items():
+            vals[key] = (dummytime, v)
+            vals[f'metadata/snapshot_age/{key}'] = (dummytime, age)
+        vals['end_time'] = (dummytime, str(datetime.datetime.now().astimezone().isoformat()))
+        return vals
+
+    def _write_values(self, vals, snapshot=True):
+        '''Writes vals into all files. With snapshot=False, the detectors and environment are not read and written along with them.'''
         def validate_and_add(key_to_check, name, typ, group):
             tags = key_to_check.split(':')
             k = tags[-1]
@@ -145,88 +836,153 @@ class HDF5ScanfileSinkHandler(DataSinkHandler):
                     else:
                         group.attrs[name] = [ k ]
                 elif(typ == 'single'):
+                    if(group.attrs.get(name, None) == bytes(k, 'utf-8')):
+                        return k # unchanged. Also, attributes cannot be written in SWMR mode
                     try:
                         group.attrs.modify(name, bytes(k, 'utf-8'))
                     except:
                         group.attrs[name] = bytes(k, 'utf-8')
             return k
             
-        def write_val(key, val, d):
+        def write_val(key, val, d, settings, file):
             validate_and_add(key, 'axes', 'list', d)
             validate_and_add(key, 'signal', 'single', d)
             key = validate_and_add(key, 'auxiliary_signals', 'list', d)
-            newg = self.__save_val(val, key, file, d)
+            if(isinstance(val, UniformAxis)) and not(self.sink.swmr) and (f'/shared_axes/{val.shared_name(key)}' in file):
+                self._deferred_links.pop((file.filename, d.name, key), None)
+                self.__link_shared_axis(val, key, file, d) # stored already, no copy in the entry
+                return
+            if(isinstance(val, (UniformAxis, SharedGroup))):
+                # written in place while the point runs, and only linked to the shared copy once it has finished (see _finish_structure)
+                self._deferred_links[(file.filename, d.name, key)] = (val, settings)
+                self.__unlink(file, d, key)
+                val = val.values
+            newg = self.__save_val(val, key, file, d, settings)
             
-        def write_time_val_pair(file, key, val_pair):
-            '''file should be an _open_ HDF file object. Writes a value to the appropriate dataset (based on key) and entry (based on timestamp in val_pair[0])'''
+        if(self.sink.complex_signals):
+            vals = combine_complex(vals, self.sink.complex_dtype)
+        
+        # one snapshot of the detectors and environment per write, shared by all files
+        if(snapshot):
+            vals = self._add_snapshot(vals)
+        
+        t0 = time.monotonic()
+        ops, end_time = self._prepare(vals)
+        self._phase('sink_prepare', t0)
+        
+        def apply(f):
+            with self._open_file(f) as file:
+                if not(f in self._entry_indices):
+                    self._entry_indices[f] = EntryIndex(file)
+                index = self._entry_indices[f]
+                entries = {}
+                for (start_dt_iso, name, target_groups, formatted_key, value, settings) in ops:
+                    # Get the correct entry (entryX, where X is an integer). Creates a new entry if necessary
+                    if not(start_dt_iso in entries):
+                        g, new_dataset = choose_entry_from_datetime(file, start_dt_iso, index)
+                        if(new_dataset) and (g.name.lstrip('/') in index.precreated):
+                            self._bump_generation(file, changing=not(file.swmr_mode)) # the spare entry has become a real one
+                        if not(end_time is None):
+                            g['end_time'][0] = end_time
+                        entries[start_dt_iso] = g
+                    g = entries[start_dt_iso]
+                    self._point_entries[f] = g.name
+                    for group_key in target_groups:
+                        if(group_key == 'initial_environment'):
+                            # only the first value goes in here. The datasets of a spare entry exist from the start, so for those it is remembered here
+                            if(g.name.lstrip('/') in index.precreated):
+                                written = self._initial_written.setdefault((f, g.name), set())
+                                if(name in written):
+                                    continue
+                                written.add(name)
+                            elif(name in g['initial_environment']):
+                                continue
+                        write_val(formatted_key, value, g.require_group(group_key), settings, file)
+        
+        # the first file is written right away, the others (if any) are either written right away as well, or in the background (mirror_async)
+        if(self.sink.swmr):
+            write = lambda f: self._swmr_apply(apply, f, lambda file: self._in_place(file, f, ops))
+        else:
+            write = apply
+        t1 = time.monotonic()
+        write(self._filepaths[0])
+        self._phase('sink_write', t1)
+        t1 = time.monotonic()
+        for f in self._filepaths[1:]:
+            if(self.sink.mirror_async):
+                self._submit_mirror(write, f)
+            else:
+                write(f)
+        if(len(self._filepaths) > 1):
+            self._phase('sink_mirror', t1)
+        t1 = time.monotonic()
+        self._flush()
+        self._phase('sink_flush', t1)
+        self._num_writes += 1
+        self._write_time += time.monotonic() - t0
+
+    def _prepare(self, vals):
+        '''Does all the work for writing vals that does not depend on the file, so that it is done once, no matter how many files are written.
+        Returns a list of (entry start time (ISO8061), name, target groups, formatted key, value, storage settings), and the new end time of the entries
+        (None if vals do not have one, i.e., were written without a snapshot of the devices).'''
+        isos = {}
+        ops = []
+        end_time = None
+        for key, (timestamp, value) in vals.items():
+            if(key == 'end_time'):
+                end_time = value # see _add_snapshot
+                continue
+            if(key.startswith('derived:')):
+                key = key[len('derived:'):] # only tells putValues not to take a snapshot
             # get start datetime to find the correct entry:
-            timestamp = val_pair[0]
-            value = val_pair[1]
-            start_dt = datetime.datetime.fromtimestamp(timestamp)
-            start_dt_iso = str(start_dt.astimezone().isoformat())
-            
-            # Get the correct entry (entryX, where X is an integer). Creates a new entry if necessary
-            g, new_dataset = choose_entry_from_datetime(file, start_dt_iso)
-            # update end time
-            et_dataset = g['end_time']
-            et_dataset[0] = str(datetime.datetime.now().astimezone().isoformat())
+            if not(timestamp in isos):
+                isos[timestamp] = str(datetime.datetime.fromtimestamp(timestamp).astimezone().isoformat())
             
             target_groups = [] # keys of groups to write to. Can be multiple for the existence of the initial_environment.
             # choose the appropriate group within the entry
             if(key in session.experiment.detlist):
                 target_groups += ['detectors']
             if(key in session.experiment.envlist) or ('environment/' in key):
-                target_groups += ['environment']
-                if not(key in g['initial_environment'].keys()):
-                    target_groups += ['initial_environment']
+                target_groups += ['environment', 'initial_environment']
             if('metadata/' in key):
                 target_groups += ['metadata']
+            if(key.startswith('initial_environment/')):
+                target_groups = ['initial_environment'] # a value that was replaced in the queue of the background writer, see putValues
             if(len(target_groups) == 0):
                 target_groups += ['nmr_data']
-                
-            for group_key in target_groups:
-                data_group = g.require_group(group_key)
-                
-                # remove any special characters from the key
-                formatted_key = key
-                tagsplit = formatted_key.split(':')
-                tags = ':'.join(tagsplit[:-1]) # take everything before the last ':', these are used to signal special 'tags' on data, such as signal, axes, etc.
-                formatted_key = tagsplit[-1]
-                # remove the location specifier before the first '/' (multiple locations are not supported)
-                if('/' in formatted_key):
-                    formatted_key = '/'.join(formatted_key.split('/')[1:])
-                formatted_key = tags + ':' + formatted_key # recombine...
-                
-                #... for write_val to do its job
-                write_val(formatted_key, value, data_group)
             
-        for f in self._filepaths:
-            with hdf.File(f, 'a') as file:
-                dummytime = 0
-                for key, val in vals.items():
-                    write_time_val_pair(file, key, val)
-                    dummytime = val[0]
-                
-                for key in session.experiment.detlist + session.experiment.envlist:
-                    unread = True
-                    v = 0
-                    retries = 0
-                    while(unread):
-                        try:
-                            v = session.getDevice(key).read()
-                            unread = False
-                        except:
-                            retries += 1
-                            if(retries > 10):
-                                session.log.info(f'Failed to read {key}. Setting zero.')
-                                v = 0
-                                break
-                            session.log.info(f'Trying to read {key} again')
-                            pass
-                    if(dummytime == 0):
-                        dummytime = time.time()
-                    val = (dummytime, v)
-                    write_time_val_pair(file, key, val)
+            # remove any special characters from the key
+            tagsplit = key.split(':')
+            tags = ':'.join(tagsplit[:-1]) # take everything before the last ':', these are used to signal special 'tags' on data, such as signal, axes, etc.
+            name = tagsplit[-1]
+            # remove the location specifier before the first '/' (multiple locations are not supported)
+            if('/' in name):
+                name = '/'.join(name.split('/')[1:])
+            formatted_key = tags + ':' + name # recombine for write_val to do its job
+            
+            settings = match_policy(self.sink.storage_policy, key)
+            value = prepare_value(value, settings)
+            if(self.sink.shared_axes) and ('axes' in tagsplit[:-1]) and isinstance(value, np.ndarray):
+                value = as_uniform_axis(value) or value # evenly spaced axes are stored once per file
+            if(name in self.sink.shared_groups) and isinstance(value, dict):
+                value = SharedGroup(value, content_digest({ name: value })) # identical groups are stored once per file
+            ops += [ (isos[timestamp], name, target_groups, formatted_key, value, settings) ]
+        return ops, end_time
+
+    def _submit_mirror(self, func, f):
+        if(self._mirror_pool is None):
+            self._mirror_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='HDF5 NeXus mirror') # one worker, so the writes stay in order
+        while len(self._mirror_futures) >= self.sink.queue_size:
+            self._mirror_futures.pop(0).result() # backpressure
+        self._mirror_futures += [ self._mirror_pool.submit(func, f) ]
+
+    def _drain_mirrors(self):
+        for fut in self._mirror_futures:
+            try:
+                fut.result()
+            except Exception:
+                session.log.warning('HDF_NeXus: writing a mirror file failed', exc=1)
+        self._mirror_futures = []
                 
     
     def putResults(self, quality, results):
@@ -234,16 +990,89 @@ class HDF5ScanfileSinkHandler(DataSinkHandler):
         #session.log.info('HDF_NeXus putResults is not implemented! Use putValues.')
         
     def addSubset(self, subset):
-        pass
-        #session.log.info('HDF_NeXus addSubset is not implemented! Use putValues.')
+        # called once a point has finished, so this is a good moment to get everything onto the disk.
+        t0 = time.monotonic()
+        self._drain()
+        self._phase('sink_drain', t0)
+        if(self._timing) and (self._phases) and not(self._point_timestamp is None):
+            # into the same group as the timing of the commands (metadata/timing), without another snapshot of the devices
+            self._write_values({ 'metadata/timing': (self._point_timestamp, dict(self._phases)) }, snapshot=False)
+            self._drain_mirrors()
+        self._finish_structure()
+        self._drain_mirrors()
+        self._timing_stats.add(self._phases)
+        self._phases = {}
+        self._point_timestamp = None
+        self._timing = self.sink.phase_timing
+        self._last_written = {}
+        self._flush(force=True)
+        self._report_io()
         
-    #def end(self):
-    #    pass # nothing afaik needs to be done here.
+    def end(self):
+        self._drain()
+        self._stop_writer()
+        if not(self._pool is None):
+            self._pool.shutdown(wait=False)
+            self._pool = None
+        if not(self._mirror_pool is None):
+            self._mirror_pool.shutdown()
+            self._mirror_pool = None
+        self._last_written = {}
+        if(self.sink.swmr):
+            self._remove_spares()
+        self._close_files()
+        self._report_io()
+        self._timing_stats.publish(f'{self.sink.name}/phase_timing')
 
 
 class HDF5ScanfileSink(FileSink):
     
     handlerclass = HDF5ScanfileSinkHandler
+    parameters = {
+        'keep_open': Param('Keep the scan files open from prepare until the end of the scan, instead of reopening them for every write',
+                           type=bool, default=False),
+        'flush_interval': Param('Maximum time between flushes of held-open files (in addition to a flush after every point)',
+                                type=floatrange(0), default=10.0, unit='s'),
+        'async_write': Param('Write to the files from a background thread, so that slow I/O does not hold up the acquisition. The detectors and '
+                             'environment are still read when the values are put',
+                             type=bool, default=False),
+        'queue_size': Param('Maximum number of values waiting for the background writer before putValues blocks',
+                            type=intrange(1, 100000), default=256),
+        'queue_depth': Param('Largest number of values waiting for the background writer during the last scan',
+                             type=int, default=0, settable=False, internal=True),
+        'write_latency': Param('Average time taken per write during the last scan',
+                               type=float, default=0.0, settable=False, internal=True, unit='s'),
+        'snapshot_maxage': Param('Detector/environment values younger than this are taken from the cache instead of being read from the device',
+                                 type=floatrange(0), default=1.0, unit='s'),
+        'snapshot_timeout': Param('Maximum time to wait for a single detector/environment device to be read',
+                                  type=floatrange(0), default=2.0, unit='s'),
+        'snapshot_total_timeout': Param('Maximum time to wait for the whole detector/environment snapshot',
+                                        type=floatrange(0), default=5.0, unit='s'),
+        'snapshot_retries': Param('Number of times a failed detector/environment read is retried (with exponential backoff)',
+                                  type=intrange(0, 100), default=3),
+        'storage_policy': Param('Compression, chunking and dtype settings for array datasets, by key pattern (see storage_policy.py), '
+                                'e.g. {"signal:*": {"compression": "gzip", "level": 4, "shuffle": True, "dtype": "float32"}}',
+                                type=storagepolicy, default={}),
+        'complex_signals': Param('Store <name>_reals/<name>_imags pairs (such as the TNMR FID) as a single complex dataset <name>_fid',
+                                 type=bool, default=False),
+        'complex_dtype': Param('Data type of the complex datasets written with complex_signals',
+                               type=oneof('complex64', 'complex128'), default='complex128'),
+        'shared_axes': Param('Store evenly spaced axes (such as tnmr_times) once per file in /shared_axes, and hard-link them from the entries '
+                             '(an axis which is not stored yet is written into the entry during the point, and linked once it has finished)',
+                             type=bool, default=False),
+        'shared_groups': Param('Names of dictionary values (such as tnmr_sequence and tnmr_params) which are stored once per file in /sequences/<hash>, and hard-linked from every entry with the same contents '
+                               '(written into the entry during the point, and linked once it has finished)',
+                               type=listof(str), default=[]),
+        'phase_timing': Param('Time the phases of every write (device snapshot, preparation, writing, flushing...), store them per point in '
+                              'metadata/timing, and publish their percentiles at the end of the scan', type=bool, default=False, settable=True),
+        'swmr': Param('Write the files in HDF5 single-writer/multiple-reader mode, so that they can be read (with swmr=True, e.g., by '
+                      'sinks/nexus_reader.LiveScan) while the scan is running. Implies keep_open. At the end of each point, the entry of the next '
+                      'point is created ahead of time (without a start time; readers skip it), so that it can be written without leaving SWMR mode. '
+                      'A file which was not closed (e.g. after a crash) stays marked as open for writing; it is unmarked (as h5clear -s does) when '
+                      'a scan is resumed into it', type=bool, default=False),
+        'mirror_async': Param('If there are several filename templates, write only the first file inline and the others from a background thread',
+                              type=bool, default=False),
+    }
     parameter_overrides = {
         'settypes': Override(default=[SCAN, SUBSCAN]),
         'filenametemplate': Override(default=['%(proposal)s_%(year)04d-%(month)02d-%(day)02d_%(hour)02d-%(minute)02d-%(second)02d.hdf'])
@@ -0,0 +1,408 @@
+# *****************************************************************************
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Davis V. Garrad <davis.last@psi.ch>
+#
+# *****************************************************************************
+
+# Reading the scan files of the HDF5 NeXus sink (HDF5_NEXUS.py) as whole-scan arrays, without NICOS:
+#   scan = NexusScan('file.hdf')
+#   fids = scan.fids[100:200]           # (100, T) complex array, read in one batch
+#   delays = scan.sequence()['0/delay_time']
+# Files which are still being written (by a sink with swmr set) are followed with LiveScan:
+#   scan = LiveScan('file.hdf')
+#   while acquiring:
+#       for i in scan.poll(): ...      # entries which are new or have grown
+# Only h5py and numpy are needed.
+
+import os
+
+import h5py as hdf
+import numpy as np
+
+INDEX_VERSION = 1
+
+def entry_number(name):
+    return int(name[len('entry'):])
+
+def read_string(ds):
+    '''Value of a (fixed-length or variable-length) string dataset of shape (1,), without padding.'''
+    v = ds[0] if ds.shape else ds[()]
+    if(isinstance(v, bytes)):
+        v = v.decode('utf-8', 'replace')
+    return str(v).rstrip('\x00')
+
+def as_column(values):
+    '''Turns one value per entry (None where an entry does not have it) into an array: float (NaN for missing), bool, or str ('' for missing).'''
+    present = [ v for v in values if not(v is None) ]
+    if(present) and all(isinstance(v, (bool, np.bool_)) for v in present) and (len(present) == len(values)):
+        return np.array(values, dtype=bool)
+    if(present) and all(isinstance(v, (int, float, np.integer, np.floating)) and not isinstance(v, (bool, np.bool_)) for v in present):
+        if(len(present) == len(values)) and all(isinstance(v, (int, np.integer)) for v in present):
+            return np.array(values, dtype=np.int64)
+        return np.array([ np.nan if (v is None) else v for v in values ], dtype=np.float64)
+    return np.array([ '' if (v is None) else str(v) for v in values ], dtype=str)
+
+def scalar_value(ds):
+    '''The value of a one-element dataset as a plain Python value, or None for anything bigger.'''
+    if(ds.size != 1):
+        return None
+    if(ds.dtype.kind in 'SUO'):
+        return read_string(ds)
+    v = ds[()]
+    v = v.reshape(-1)[0] if isinstance(v, np.ndarray) else v
+    return v.item() if isinstance(v, np.generic) else v
+
+class LazyStack:
+    '''The datasets at the same path in every entry, seen as one (number of entries, length) array which is read only when indexed.
+    Rows shorter than the longest are padded with NaN. A row selection is read in one pass, every dataset straight into its row of the result
+    (read_direct), and a column slice is widened to whole chunks of the datasets, so no chunk is decompressed twice.'''
+    def __init__(self, file, entries, paths, lengths, dtype):
+        self.file = file
+        self.entries = entries
+        self.paths = paths # one path, or (reals path, imags path) which are combined into complex values
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.dtype = np.dtype(dtype)
+        self.shape = (len(entries), int(self.lengths.max()) if len(entries) else 0)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[:]
+        return arr if (dtype is None) else arr.astype(dtype)
+
+    def _rows(self, sel):
+        if(isinstance(sel, (int, np.integer))):
+            return np.array([ sel if sel >= 0 else self.shape[0] + sel ]), True
+        if(isinstance(sel, slice)):
+            return np.arange(*sel.indices(self.shape[0])), False
+        sel = np.asarray(sel)
+        if(sel.dtype == bool):
+            return np.nonzero(sel)[0], False
+        return np.where(sel < 0, sel + self.shape[0], sel), False
+
+    def _chunk_aligned(self, ds, c0, c1):
+        '''Widens [c0, c1) to whole chunks of ds.'''
+        if(ds.chunks is None):
+            return c0, min(ds.shape[0], c1)
+        c = ds.chunks[0]
+        return (c0//c)*c, min(ds.shape[0], -(-c1//c)*c)
+
+    def _read(self, path, rows, c0, c1, dtype):
+        out = np.full((len(rows), c1 - c0), np.nan, dtype=dtype)
+        for i, r in enumerate(rows):
+            n = min(int(self.lengths[r]), c1) - c0
+            if(n <= 0):
+                continue
+            ds = self.file[f'{self.entries[r]}/{path}']
+            a0, a1 = self._chunk_aligned(ds, c0, c0 + n)
+            if(a0 == c0) and (a1 == c0 + n):
+                ds.read_direct(out, source_sel=np.s_[c0:c0 + n], dest_sel=np.s_[i, 0:n])
+            else:
+                part = ds[a0:a1][c0 - a0:c0 - a0 + n] # shorter than n if the dataset has not grown as far as it was indexed
+                out[i, :len(part)] = part
+        return out
+
+    def __getitem__(self, key):
+        rsel, csel = (key if isinstance(key, tuple) else (key, slice(None)))
+        rows, single = self._rows(rsel)
+        pick = isinstance(csel, (int, np.integer))
+        cols = np.array([ csel % self.shape[1] ]) if pick else np.arange(*csel.indices(self.shape[1]))
+        c0, c1 = (int(cols.min()), int(cols.max()) + 1) if len(cols) else (0, 0)
+        if(isinstance(self.paths, tuple)):
+            out = self._read(self.paths[0], rows, c0, c1, np.float64) + 1j*self._read(self.paths[1], rows, c0, c1, np.float64)
+            out = out.astype(self.dtype, copy=False)
+        else:
+            out = self._read(self.paths, rows, c0, c1, self.dtype)
+        if not(len(cols) == c1 - c0) or (len(cols) > 1 and cols[0] > cols[-1]):
+            out = out[:, cols - c0] # strided or reversed columns
+        if(pick):
+            out = out[:, 0]
+        return out[0] if single else out
+
+    def batches(self, batch_size=256):
+        '''Yields (first row, array of rows) for the whole stack, batch_size rows at a time.'''
+        for start in range(0, self.shape[0], batch_size):
+            yield start, self[start:start + batch_size]
+
+class NexusScan:
+    '''One scan file of the HDF5 NeXus sink. The entries are indexed once, when the file is opened (start times, FID lengths, and the values of
+    the sequence, params, environment and metadata groups as columns). With sidecar=True (or a path), the index is kept next to the file
+    (<file>.index.npz) and reused on the next open; if the file has grown since, only the new entries (and the last one indexed) are read again.'''
+    SIGNALS = ('tnmr_fid', 'tnmr_reals')
+    COLUMN_GROUPS = { 'sequence': 'nmr_data/tnmr_sequence', 'params': 'nmr_data/tnmr_params', 'environment': 'environment', 'metadata': 'metadata' }
+
+    def __init__(self, path, sidecar=False, **kwargs):
+        self.path = path
+        self._open_kwargs = kwargs
+        self.file = self._open()
+        if(sidecar is True):
+            sidecar = path + '.index.npz'
+        self.sidecar = sidecar or None
+        self._fid_stack = None
+        self._group_values = {} # object id -> values of a group, so that groups shared by many entries (shared_groups) are read once
+        self._recs = {} # entry name -> index record, from the last reindex
+        self.reindex()
+
+    def _open(self):
+        return hdf.File(self.path, 'r', **self._open_kwargs)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __len__(self):
+        return len(self.entries)
+
+    # indexing
+    def _entry_names(self):
+        return sorted((n for n in self.file.keys() if n.startswith('entry') and n[5:].isdigit()), key=entry_number)
+
+    def _index_entry(self, name):
+        '''Start time, signal layout, FID length and dtype, and the one-element values of the column groups, for one entry.'''
+        g = self.file[name]
+        rec = { 'start_time': read_string(g['start_time']) if 'start_time' in g else '', 'layout': '', 'length': 0, 'dtype': '', 'columns': {} }
+        data = g.get('nmr_data', None)
+        if not(data is None):
+            for signal in self.SIGNALS:
+                if(signal in data):
+                    ds = data[signal]
+                    rec['layout'] = 'complex' if (signal == 'tnmr_fid') else 'split'
+                    rec['length'] = int(ds.shape[0]) if ds.shape else 0
+                    rec['dtype'] = ds.dtype.str if (signal == 'tnmr_fid') else np.result_type(ds.dtype, np.complex64).str
+                    break
+        for group, path in self.COLUMN_GROUPS.items():
+            if not(path in g):
+                continue
+            gg = g[path]
+            key = hash(gg.id)
+            if not(key in self._group_values):
+                values = {}
+                def visit(name, obj):
+                    if(isinstance(obj, hdf.Dataset)) and not(group == 'metadata' and name.startswith('timing')):
+                        v = scalar_value(obj)
+                        if not(v is None):
+                            values[name] = v
+                gg.visititems(visit)
+                self._group_values[key] = values
+            rec['columns'].update((f'{group}:{k}', v) for k, v in self._group_values[key].items())
+        return rec
+
+    def _stat(self):
+        st = os.stat(self.path)
+        return st.st_size, st.st_mtime_ns
+
+    def _load_sidecar(self):
+        if(self.sidecar is None) or not(os.path.exists(self.sidecar)):
+            return None
+        try:
+            with np.load(self.sidecar, allow_pickle=False) as z:
+                if(int(z['version']) != INDEX_VERSION):
+                    return None
+                size, mtime = int(z['source_size']), int(z['source_mtime'])
+                names = [ str(n) for n in z['entries'] ]
+                recs = {}
+                cols = { k[4:]: z[k] for k in z.files if k.startswith('col:') }
+                for i, n in enumerate(names):
+                    recs[n] = { 'start_time': str(z['start_times'][i]), 'layout': str(z['layouts'][i]), 'length': int(z['lengths'][i]),
+                                'dtype': str(z['dtypes'][i]),
+                                'columns': { k: c[i].item() for k, c in cols.items() if not(self._missing(c, i)) } }
+                return (size, mtime), recs
+        except Exception:
+            return None
+
+    @staticmethod
+    def _missing(col, i):
+        v = col[i]
+        return (col.dtype.kind == 'f' and np.isnan(v)) or (col.dtype.kind == 'U' and v == '')
+
+    def _save_sidecar(self):
+        if(self.sidecar is None):
+            return
+        size, mtime = self._stat()
+        arrays = { 'version': np.array(INDEX_VERSION), 'source_size': np.array(size), 'source_mtime': np.array(mtime),
+                   'entries': np.array(self.entries, dtype=str), 'start_times': self.start_times, 'layouts': self.layouts,
+                   'lengths': self.lengths, 'dtypes': np.array(self._dtypes, dtype=str) }
+        for k, c in self._columns.items():
+            arrays['col:' + k] = c
+        try:
+            tmp = self.sidecar + '.tmp.npz'
+            np.savez(tmp, **arrays)
+            os.replace(tmp, self.sidecar)
+        except OSError:
+            pass # read-only directory; the index is just not kept
+
+    def reindex(self):
+        '''(Re)builds the index: from the sidecar where it is still valid, and from the file for everything else.'''
+        names = self._entry_names()
+        recs = {}
+        self._group_values = {}
+        loaded = self._load_sidecar()
+        if not(loaded is None):
+            stat, old = loaded
+            if(stat == self._stat()):
+                recs = old
+            else:
+                known = [ n for n in names if n in old ]
+                recs = { n: old[n] for n in known[:-1] } # the last known entry may have been written to since
+        known = [ n for n in names if n in self._recs ]
+        for n in known[:-1]:
+            recs.setdefault(n, self._recs[n])
+        for n in names:
+            if not(n in recs):
+                recs[n] = self._index_entry(n)
+        names = [ n for n in names if recs[n]['start_time'] != '' ] # spare entries of a file written with swmr, not started yet
+        recs = { n: recs[n] for n in names }
+        changed = (loaded is None) or (len(recs) != len(loaded[1])) or (loaded[0] != self._stat())
+        
+        self.entries = names
+        self._recs = recs
+        self._build_arrays()
+        keys = sorted(set().union(*[ recs[n]['columns'].keys() for n in names ])) if names else []
+        self._columns = { k: as_column([ recs[n]['columns'].get(k, None) for n in names ]) for k in keys }
+        if(changed):
+            self._save_sidecar()
+        return self
+
+    def _build_arrays(self):
+        names, recs = self.entries, self._recs
+        self.start_times = np.array([ recs[n]['start_time'] for n in names ], dtype=str)
+        self.layouts = np.array([ recs[n]['layout'] for n in names ], dtype=str)
+        self.lengths = np.array([ recs[n]['length'] for n in names ], dtype=np.int64)
+        self._dtypes = [ recs[n]['dtype'] for n in names ]
+        self._fid_stack = None
+
+    # data
+    @property
+    def fids(self):
+        '''All FIDs as a lazily read (entries, points) complex array (see LazyStack).'''
+        if(self._fid_stack is None):
+            layouts = set(l for l in self.layouts if l)
+            if(len(layouts) > 1):
+                raise ValueError(f'{self.path} mixes FID layouts ({sorted(layouts)})')
+            dtype = np.result_type(*[ np.dtype(d) for d in self._dtypes if d ]) if any(self._dtypes) else np.complex128
+            paths = 'nmr_data/tnmr_fid' if (layouts == { 'complex' }) else ('nmr_data/tnmr_reals', 'nmr_data/tnmr_imags')
+            self._fid_stack = LazyStack(self.file, self.entries, paths, self.lengths, dtype)
+        return self._fid_stack
+
+    def times(self):
+        '''The time axis: a single array if every entry links to the same (shared) axis, or a lazily read stack like fids.'''
+        objs = [ self.file[f'{n}/nmr_data/tnmr_times'] for n in self.entries if 'tnmr_times' in self.file[n].get('nmr_data', {}) ]
+        if(objs) and (len(objs) == len(self.entries)) and (len(set(hash(o.id) for o in objs)) == 1):
+            return objs[0][()]
+        return LazyStack(self.file, self.entries, 'nmr_data/tnmr_times', self.lengths, np.float64)
+
+    def columns(self, group):
+        '''One array per value of a group ("sequence", "params", "environment" or "metadata"), with one element per entry. Nested keys are joined
+        with "/", e.g. sequence()["0/delay_time"]. Entries without a value get NaN (numbers) or "" (strings).'''
+        prefix = group + ':'
+        return { k[len(prefix):]: c for k, c in self._columns.items() if k.startswith(prefix) }
+
+    def sequence(self):
+        return self.columns('sequence')
+
+    def params(self):
+        return self.columns('params')
+
+    def environment(self):
+        return self.columns('environment')
+
+    def metadata(self):
+        return self.columns('metadata')
+
+class LiveScan(NexusScan):
+    '''A scan file which is still being written by the sink (with swmr set), opened as an HDF5 SWMR reader. poll() brings it up to date: as long as
+    the writer only appends to existing datasets, just the datasets of the last entry are refreshed. When the writer has created new objects (a new
+    entry, or new keys), which it marks by incrementing metadata/swmr_generation, the file is reopened and only the new entries (and the last one
+    indexed) are indexed again. While the generation is odd, the writer is changing the structure, and the file is left alone until the next poll.
+    Files written without swmr can be followed too, but are then reopened on every poll.
+    The file is opened without locking (like the sink does), so that following a file never keeps the sink from writing it.'''
+    def __init__(self, path, **kwargs):
+        kwargs.setdefault('libver', 'latest')
+        kwargs.setdefault('locking', False)
+        super().__init__(path, sidecar=False, **kwargs) # the file changes all the time, an index next to it would be out of date anyway
+        self._generation = self._read_generation()
+
+    def _open(self):
+        try:
+            return hdf.File(self.path, 'r', swmr=True, **self._open_kwargs)
+        except OSError:
+            return hdf.File(self.path, 'r', **self._open_kwargs) # not (at the moment) written in SWMR mode
+
+    def _read_generation(self):
+        ds = self.file.get('metadata/swmr_generation', None)
+        if(ds is None):
+            return None
+        ds.refresh()
+        return int(ds[0])
+
+    def _reopen(self):
+        self.file.close()
+        self.file = self._open()
+        generation = self._read_generation()
+        self.reindex()
+        if(self._read_generation() != generation):
+            generation = None # changed while indexing, reopened again on the next poll
+        self._generation = generation
+
+    def _refresh_last(self):
+        '''Re-reads the datasets of the last entry (the one being written) and updates its FID length and column values.'''
+        if not(self.entries):
+            return
+        name = self.entries[-1]
+        g = self.file[name]
+        def refresh(n, obj):
+            if(isinstance(obj, hdf.Dataset)):
+                obj.refresh()
+        g.visititems(refresh)
+        for path in self.COLUMN_GROUPS.values():
+            if(path in g):
+                self._group_values.pop(hash(g[path].id), None)
+        old = self._recs[name]
+        rec = self._index_entry(name)
+        self._recs[name] = rec
+        if(rec['length'] != old['length']) or (rec['layout'] != old['layout']) or (rec['dtype'] != old['dtype']):
+            self._build_arrays()
+        for k in set(rec['columns']) | set(old['columns']):
+            if(rec['columns'].get(k, None) != old['columns'].get(k, None)):
+                self._columns[k] = as_column([ self._recs[n]['columns'].get(k, None) for n in self.entries ])
+
+    def poll(self):
+        '''Brings the scan up to date with the file. Returns the indices of the entries which are new, or whose FID has grown, since the last poll.'''
+        lengths = dict(zip(self.entries, self.lengths))
+        try:
+            generation = self._read_generation()
+            if not(generation is None) and (generation % 2):
+                return [] # the writer is changing the structure of the file
+            reopen = (generation is None) or (generation != self._generation)
+            if not(reopen):
+                self._refresh_last()
+        except Exception:
+            reopen = True # e.g., caught the writer in the middle of a change of the structure
+        if(reopen):
+            try:
+                self._reopen()
+            except Exception:
+                return [] # tried again on the next poll
+        return [ i for i, (n, l) in enumerate(zip(self.entries, self.lengths)) if l != lengths.get(n, -1) ]
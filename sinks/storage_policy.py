@@ -0,0 +1,85 @@
+# *****************************************************************************
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Davis V. Garrad <davis.last@psi.ch>
+#
+# *****************************************************************************
+
+# Storage policies for the array datasets of the NeXus sink. Kept free of NICOS imports, so that the benchmarks can use it as well.
+#
+# A policy is a dictionary of key pattern (fnmatch-style, matched against the key as given to putValues, e.g. 'signal:tnmr_reals') -> settings.
+# The first matching pattern wins. The settings are all optional:
+#   'compression': 'gzip', 'lzf', or None
+#   'level':       gzip level (0-9)
+#   'shuffle':     True/False, byte shuffle filter (helps compression of numeric data a lot)
+#   'chunks':      chunk length along the first axis (int), or a full chunk shape (tuple/list)
+#   'dtype':       'float32' to down-cast float64 (and complex128 to complex64) before writing
+# Example:
+#   { 'signal:*': {'compression': 'gzip', 'level': 4, 'shuffle': True, 'dtype': 'float32'},
+#     'auxiliary_signals:*': {'compression': 'lzf', 'shuffle': True, 'dtype': 'float32'} }
+
+from fnmatch import fnmatchcase
+
+import numpy as np
+
+COMPRESSION_CODECS = ('gzip', 'lzf')
+DOWNCAST_DTYPES = ('float32',)
+
+def match_policy(policy, key):
+    '''Returns the settings of the first pattern in policy which matches key, or an empty dictionary.'''
+    for pattern, settings in policy.items():
+        if(fnmatchcase(key, pattern)):
+            return settings
+    return {}
+
+def check_policy(policy):
+    '''Raises ValueError if the policy contains unknown settings.'''
+    for pattern, settings in policy.items():
+        for k in settings:
+            if not(k in ('compression', 'level', 'shuffle', 'chunks', 'dtype')):
+                raise ValueError(f'unknown storage setting {k!r} for {pattern!r}')
+        if not(settings.get('compression', None) in COMPRESSION_CODECS + (None,)):
+            raise ValueError(f'unknown compression {settings["compression"]!r} for {pattern!r}, use one of {COMPRESSION_CODECS}')
+        if not(settings.get('dtype', None) in DOWNCAST_DTYPES + (None,)):
+            raise ValueError(f'unknown dtype {settings["dtype"]!r} for {pattern!r}, use one of {DOWNCAST_DTYPES}')
+    return policy
+
+def apply_dtype(settings, varr):
+    '''Down-casts varr according to the settings (no copy if nothing is to be done).'''
+    if(settings.get('dtype', None) == 'float32'):
+        if(varr.dtype.kind == 'f' and varr.dtype.itemsize > 4):
+            return varr.astype(np.float32)
+        if(varr.dtype.kind == 'c' and varr.dtype.itemsize > 8):
+            return varr.astype(np.complex64)
+    return varr
+
+def dataset_options(settings, shape):
+    '''Returns the keyword arguments for h5py's create_dataset (chunks, maxshape, and filters) for a resizable dataset of the given initial shape.'''
+    opts = { 'maxshape': (None,)*len(shape), 'chunks': True }
+    chunks = settings.get('chunks', None)
+    if not(chunks is None):
+        if(isinstance(chunks, int)):
+            chunks = (chunks,) + tuple(max(1, s) for s in shape[1:])
+        opts['chunks'] = tuple(chunks)
+    compression = settings.get('compression', None)
+    if not(compression is None):
+        opts['compression'] = compression
+        if(compression == 'gzip'):
+            opts['compression_opts'] = settings.get('level', 4)
+    if(settings.get('shuffle', False)):
+        opts['shuffle'] = True
+    return opts